@@ -5,82 +5,63 @@ import numpy.typing as npt
 
 class Cluster:
     """
-    Data type to store clustering information
+    Data type to store clustering information: the score and WCSS of every
+    seed tried for one value of K, and the labels and centroids of the best
+    seed only (highest score, first seed on ties)
     """
 
+    __slots__ = ("best_k", "best_seed", "labels", "centroids", "scores", "wcss")
+
     def __init__(self, max_size: int) -> Cluster:
         self.best_k = 0
-        self.labels = np.repeat(None, max_size)
-        self.centroids = np.repeat(None, max_size)
-        self.scores = np.repeat(None, max_size)
-        self.wcss = np.repeat(None, max_size)
-
-    def __getitem__(
-        self, k: npt.NDArray[int] | int
-    ) -> tuple[
-        int,
-        npt.NDArray[int],
-        npt.NDArray[float],
-        npt.NDArray[float],
-        npt.NDArray[float],
-    ]:
-        """
-        Return the k value queried, and (labels, centroids, scores) for this k
-        """
-        return (
-            k,
-            self.labels[k],
-            self.centroids[k],
-            self.scores[k],
-            self.wcss[k],
-        )
+        self.best_seed = -1
+        self.labels = None
+        self.centroids = None
+        self.scores = np.full(max_size, np.nan)
+        self.wcss = np.full(max_size, np.nan)
 
     def __len__(self) -> int:
-        return len(self.labels)
+        return len(self.scores)
 
     def get_best(
         self,
     ) -> tuple[
         int,
-        npt.NDArray[int],
-        npt.NDArray[float],
-        npt.NDArray[float],
+        npt.NDArray[np.int32],
         npt.NDArray[float],
+        float,
+        float,
     ]:
         """
-        Return the data for the best value of K found by Silhouette
+        Return K, and (labels, centroids, score, wcss) of the best seed
         """
         return (
             self.best_k,
-            self.labels[self.best_k],
-            self.centroids[self.best_k],
-            self.scores[self.best_k],
-            self.wcss[self.best_k],
+            self.labels,
+            self.centroids,
+            self.scores[self.best_seed],
+            self.wcss[self.best_seed],
         )
 
     def insert(
         self,
-        k: int,
+        seed: int,
         labels: npt.NDArray[int],
         centroid: npt.NDArray[float],
         score: float,
         wcss: float,
     ) -> None:
         """
-        Insert cluster
+        Record the result of the seed at position `seed`; its labels and
+        centroids are kept only if it becomes the best seed
         """
-        # Only a single element
-        if k > len(self.labels):
-            self.labels[0] = labels
-            self.centroids[0] = centroid
-            self.scores[0] = score
-            self.wcss[0] = wcss
-        # Multiple elements
-        else:
-            self.labels[k] = labels
-            self.centroids[k] = centroid
-            self.scores[k] = score
-            self.wcss[k] = wcss
+        self.scores[seed] = score
+        self.wcss[seed] = wcss
+        best = self.best_seed
+        if best < 0 or score > self.scores[best] or (score == self.scores[best] and seed < best):
+            self.best_seed = seed
+            self.labels = np.asarray(labels, dtype=np.int32)
+            self.centroids = centroid
 
     def __str__(self):
         """
@@ -89,6 +70,7 @@ class Cluster:
         return (
             "Cluster\n"
             f"best_k = {self.best_k}\n"
+            f"best_seed = {self.best_seed}\n"
             f"labels = {self.labels}\n"
             f"centroids = {self.centroids}\n"
             f"scores = {self.scores}\n"
@@ -1,9 +1,11 @@
 import ase
 import numpy as np
-from scipy.spatial import ConvexHull
+from scipy.spatial import ConvexHull, cKDTree
 import random
 import math
 
+import core.elements as elements
+
 def fibonacci_sphere(sites:int):
     points = []
     phi = np.pi * (3. - np.sqrt(5.))  # golden angle in radians
@@ -226,3 +228,35 @@ def positining_ligand(coords, direction, dist, core_coords, Dir):
 
     aux= np.array([(p+(-direction)*(dist_atoms[pmin_site])) for p in aux])
     return aux
+
+def ligand_clash(placed_codes, placed_coords, lig_codes, lig_coords, threshold, reach):
+    """
+    True if a ligand overlaps the atoms already placed (core and previous
+    ligands), with the rule of connectivity.has_no_clash: a pair closer
+    than `reach` (2x the largest radius of the complex) clashes when
+    dist*threshold < r_i + r_j
+    """
+    placed_radii = elements.RADII[placed_codes]
+    lig_radii = elements.RADII[lig_codes]
+    neighbours = cKDTree(placed_coords).query_ball_point(lig_coords, reach)
+    for atom, ids in enumerate(neighbours):
+        if ids:
+            dist = np.linalg.norm(placed_coords[ids] - lig_coords[atom], axis=1)
+            if np.any((dist < reach) & (dist*threshold < placed_radii[ids] + lig_radii[atom])):
+                return True
+    return False
+
+def place_ligand(coords, direction, dist, core_coords, Dir, placed_codes, placed_coords, lig_codes,
+                 threshold, reach, retries):
+    """
+    positining_ligand, checking the ligand against the atoms already placed
+    and retrying with a new random rotation of the ligand on a clash.
+    Returns None when the ligand still clashes after `retries` retries
+    """
+    for attempt in range(retries+1):
+        if attempt:
+            coords = rotate_atoms(coords)
+        aux = positining_ligand(coords, direction, dist, core_coords, Dir)
+        if not ligand_clash(placed_codes, placed_coords, lig_codes, aux, threshold, reach):
+            return aux
+    return None
@@ -1,82 +1,278 @@
-import ase.neighborlist as ase_n
-from ase.io import read
 from scipy import sparse
+from scipy.spatial import cKDTree
 import glob
 import shutil
 import tqdm
 import numpy as np
+import itertools
+import math
 import time
 
+import core.elements as elements
+import core.tools as tools
+import core.storage as storage
+
 # from multiprocessing import Pool, Manager
-from joblib import Parallel, delayed
+from joblib import Parallel, delayed, effective_n_jobs
 
 
-def integrity_test(folder: str, threshold: float):
-    files=glob.glob(folder+"/unfiltered/*.xyz")
-    folder_out = folder+"/filtered"
+# ase.neighborlist.NeighborList pads every atomic cutoff with this skin
+NEIGHBOR_SKIN = 0.3
+
+# largest number of structures sent to a worker in one task
+INTEGRITY_CHUNK = 512
+
+# atom pairs compared at a time by the batched clash check
+PAIR_BLOCK = 2048
+
+# batches whose all-pairs distances (structures x atoms^2 float64) exceed
+# this size are checked with one cKDTree over the stacked structures
+DENSE_BATCH_BYTES = 1 << 20
+
+
+def close_pairs(coords, cutoff: float):
+    """
+    Pairs i<j of atoms closer than `cutoff` and their distances
+    """
+    pairs = cKDTree(coords).query_pairs(cutoff, output_type='ndarray')
+    i, j = pairs.T
+    d = np.linalg.norm(coords[i] - coords[j], axis=1)
+    keep = d < cutoff
+    return i[keep], j[keep], d[keep]
+
+def is_connected(codes, coords, threshold: float) -> bool:
+    """
+    Bonds are the pairs closer than the sum of their cutoffs
+    radius*threshold + skin, as found by ase.neighborlist.NeighborList
+    """
+    cutOff = elements.RADII[codes]*threshold + NEIGHBOR_SKIN
+    i, j, d = close_pairs(coords, 2.0*cutOff.max())
+    bonded = d < cutOff[i] + cutOff[j]
+    matrix = sparse.coo_matrix((np.ones(np.count_nonzero(bonded), dtype=bool), (i[bonded], j[bonded])),
+                               shape=(len(codes), len(codes)))
+    n_components, component_list = sparse.csgraph.connected_components(matrix, directed=False)
+    return n_components==1
+
+def has_no_clash(codes, coords, threshold: float) -> bool:
+    cutOff = elements.RADII[codes]
+    i, j, d = close_pairs(coords, 2.0*cutOff.max())
+    return not np.any(d*threshold < cutOff[i] + cutOff[j])
 
-    for file in tqdm.tqdm(files):
-        mol=read(file)
-        cutOff = ase_n.natural_cutoffs(mol)
-        # print("DEBUG: Check cutoff at connectivity")
-        cutOff = [dist*threshold for dist in cutOff]
-        neighborList = ase_n.NeighborList(cutOff, self_interaction=False, bothways=True)
-        neighborList.update(mol)
-        matrix = neighborList.get_connectivity_matrix(sparse=False)
-        n_components, component_list = sparse.csgraph.connected_components(matrix)
-
-        if n_components==1:
-            shutil.copy(file,folder_out+"/"+file.split("/")[-1])
-
-def integrity_complexes(args):
-    file, threshold, folder_out = args
-    mol=read(file)
-    cutOff = ase_n.natural_cutoffs(mol)
-    rmax = np.max(cutOff)
-    i, j, d = ase_n.neighbor_list('ijd', mol, rmax*2.0)
-    file_ok = True
-    for index_i, index_j, dist in zip(i, j, d):
-        # if index_i in [3,4,5]:
-        #     print(f"{index_i}:{index_j} - {cutOff[index_i]}+{cutOff[index_j]} -> {dist:.2f} Å")
-        if dist*threshold < (cutOff[index_i]+cutOff[index_j]):
-            file_ok = False
+def clash_free_batch(codes, coords, threshold: float, block: int = PAIR_BLOCK) -> np.ndarray:
+    """
+    has_no_clash for a batch of structures sharing the species layout
+    `codes`, coords (B, n, 3). The pair cutoff sums are computed once for
+    the layout and all pairs are compared as arrays, `block` pairs at a
+    time; structures with a clash are dropped from the following blocks
+    """
+    cutOff = elements.RADII[codes]
+    first, second = np.triu_indices(len(codes), 1)
+    sums = cutOff[first] + cutOff[second]
+    reach = 2.0*cutOff.max()
+
+    axes = np.ascontiguousarray(np.transpose(coords, (2, 0, 1))) # (3, B, n): one gather per axis
+    mask = np.ones(len(coords), dtype=bool)
+    alive = np.arange(len(coords))
+    for start in range(0, len(sums), block):
+        i, j = first[start:start+block], second[start:start+block]
+        d = np.zeros((len(alive), len(i)))
+        for axis in axes:
+            delta = axis[alive][:, i] - axis[alive][:, j]
+            d += delta*delta
+        d = np.sqrt(d)
+        clash = np.any((d < reach) & (d*threshold < sums[start:start+block]), axis=1)
+        mask[alive[clash]] = False
+        alive = alive[~clash]
+        if len(alive) == 0:
             break
-    if file_ok:
-        shutil.copy(file,folder_out+"/"+file.split("/")[-1])
+    return mask
 
-def integrity_test_complexes_hpc(folder: str, threshold: float):
-    start_time = time.time()
-    files=glob.glob(folder+"/unfiltered/*.xyz")
-    folder_out = folder+"/filtered"
-    num_tasks = len(files)
+def clash_free_stacked(codes, coords, threshold: float) -> np.ndarray:
+    """
+    has_no_clash for a batch of structures sharing the species layout
+    `codes`, coords (B, n, 3), with a single cKDTree pair query: the
+    structures are laid side by side, far enough apart not to interact
+    """
+    n = len(codes)
+    cutOff = elements.RADII[codes]
+    reach = 2.0*cutOff.max()
+    low = coords.min(axis=1)
+    span = (coords.max(axis=1) - low).max()
+    shifted = coords - low[:, np.newaxis, :]
+    shifted[:, :, 0] += (np.arange(len(coords))*(span + 2.0*reach + 1.0))[:, np.newaxis]
+    i, j = cKDTree(shifted.reshape(-1, 3)).query_pairs(reach, output_type='ndarray').T
+    flat = coords.reshape(-1, 3)
+    d = np.linalg.norm(flat[i] - flat[j], axis=1) # from the original coordinates, as has_no_clash
+    clash = (d < reach) & (d*threshold < cutOff[i % n] + cutOff[j % n])
+    mask = np.ones(len(coords), dtype=bool)
+    mask[i[clash] // n] = False
+    return mask
 
-    args = [(files[i], threshold, folder_out) for i in range(num_tasks)]
+def clash_free_chunk(batch: list, threshold: float) -> np.ndarray:
+    """
+    Group a list of (codes, coords) by species layout and check each
+    group with clash_free_batch, or clash_free_stacked when the group's
+    all-pairs distances would exceed DENSE_BATCH_BYTES.
+    Atoms are sorted by species first, so complexes of the same
+    stoichiometry share a layout whatever the order of their atoms
+    """
+    layouts = {}
+    for index, (codes, coords) in enumerate(batch):
+        order = np.argsort(codes, kind="stable")
+        layout = layouts.setdefault(codes[order].tobytes(), (codes[order], [], []))
+        layout[1].append(index)
+        layout[2].append(coords[order])
 
-    Parallel(n_jobs=-1)(delayed(integrity_complexes)(n) for n in tqdm.tqdm(args, total=num_tasks))
-    end_time = time.time()
-    print(f"\t\t\tExecution time: {end_time - start_time} seconds")
+    mask = np.zeros(len(batch), dtype=bool)
+    for codes, indices, coords in layouts.values():
+        if 8*len(indices)*len(codes)**2 > DENSE_BATCH_BYTES:
+            mask[indices] = clash_free_stacked(codes, np.stack(coords), threshold)
+        else:
+            mask[indices] = clash_free_batch(codes, np.stack(coords), threshold)
+    return mask
 
+def integrity_chunk(batch: list, threshold: float, check, batch_check=None) -> np.ndarray:
+    """
+    Worker task: pass/fail mask of a list of (codes, coords), from
+    batch_check(batch, threshold) when given (e.g. clash_free_chunk for
+    has_no_clash), otherwise from `check` structure by structure
+    """
+    if batch_check is not None:
+        return batch_check(batch, threshold)
+    return np.fromiter((check(codes, coords, threshold) for codes, coords in batch), dtype=bool, count=len(batch))
 
-def integrity_test_complexes(folder: str, threshold: float):
+def integrity_mask(frames, threshold: float, check, n_jobs: int = 1, total: int = None,
+                   chunk: int = None, batch_check=None) -> np.ndarray:
+    """
+    Boolean mask over a batch of (name, codes, coords, energy) frames,
+    True for the structures that pass `check`.
+    With n_jobs != 1 the frames are sent to the workers in chunks of
+    `chunk` structures (by default a few chunks per worker, at most
+    INTEGRITY_CHUNK) so that each task amortises the dispatch
+    """
     start_time = time.time()
-    files=glob.glob(folder+"/unfiltered/*.xyz")
+    workers = effective_n_jobs(n_jobs)
+    if chunk is None:
+        chunk = INTEGRITY_CHUNK if not total else max(1, min(INTEGRITY_CHUNK, math.ceil(total/(4*workers))))
+    frames = iter(frames)
+    batches = iter(lambda: [(codes, coords) for _, codes, coords, _ in itertools.islice(frames, chunk)], [])
+
+    if workers == 1:
+        masks = [integrity_chunk(batch, threshold, check, batch_check) for batch in batches]
+    else:
+        masks = Parallel(n_jobs=n_jobs)(delayed(integrity_chunk)(batch, threshold, check, batch_check)
+                                        for batch in batches)
+    mask = np.concatenate(masks) if masks else np.zeros(0, dtype=bool)
+
+    elapsed = time.time() - start_time
+    print(f"\t\t\tIntegrity test: {len(mask)} structures in {elapsed:.2f} s "
+          f"({len(mask)/max(elapsed, 1e-9):.1f} structures/s, {workers} worker(s), {np.count_nonzero(mask)} passed)")
+    return mask
+
+class StreamFilter:
+    """
+    Output target that checks the structures as they are generated and
+    only forwards the survivors to `target` (a folder, archive or store
+    from storage.open_stage), so nothing is written to unfiltered/.
+    Structures are checked in batches of `buffer`; once `limit` valid
+    structures have been forwarded `done` is set and further writes are
+    ignored, so the generators can stop early
+    """
+
+    def __init__(self, target, threshold: float, check, limit: int = None, buffer: int = INTEGRITY_CHUNK,
+                 batch_check=None):
+        self.target = target
+        self.threshold = threshold
+        self.check = check
+        self.batch_check = batch_check
+        self.limit = limit
+        self.buffer_size = buffer
+        self.buffer = []
+        self.seen = 0
+        self.passed = 0
+
+    def __len__(self) -> int:
+        """
+        Structures written to the filter so far, checked or not
+        """
+        return self.seen
+
+    @property
+    def done(self) -> bool:
+        return self.limit is not None and self.passed >= self.limit
+
+    def write(self, list_atoms, list_coords, energy, pfile: str, **provenance) -> None:
+        """
+        Queue a structure, same arguments as tools.generateXYZ
+        """
+        if self.done:
+            return
+        self.buffer.append((elements.encode(list_atoms), np.array(list_coords, dtype=float),
+                            energy, pfile, provenance))
+        self.seen += 1
+        pending = self.buffer_size if self.limit is None else min(self.buffer_size, self.limit - self.passed)
+        if len(self.buffer) >= pending:
+            self.flush()
+
+    def import_file(self, fname: str, name: str) -> None:
+        for _, codes, coords, energy in tools.readFrames(fname):
+            self.write(elements.decode(codes), coords, energy, name)
+
+    def flush(self) -> None:
+        if not self.buffer:
+            return
+        mask = integrity_chunk([(codes, coords) for codes, coords, _, _, _ in self.buffer], self.threshold,
+                               self.check, self.batch_check)
+        for (codes, coords, energy, pfile, provenance), ok in zip(self.buffer, mask):
+            if ok and not self.done:
+                tools.generateXYZ(elements.decode(codes), coords, energy, pfile, self.target, **provenance)
+                self.passed += 1
+        self.buffer = []
+
+    def close(self) -> None:
+        self.flush()
+        storage.close_stage(self.target)
+        print(f"\t\t\tStreaming integrity test: {self.passed} of {self.seen} structures passed")
+
+def integrity_test_stage(folder: str, threshold: float, check, n_jobs: int = 1, batch_check=None) -> None:
+    """
+    Copy the structures of the unfiltered archive/store that pass `check`
+    to a filtered archive/store of the same kind
+    """
+    source = storage.open_source(folder+"/unfiltered")
+    mask = integrity_mask(tqdm.tqdm(source.frames(), total=len(source)), threshold, check, n_jobs, len(source),
+                          batch_check=batch_check)
+    source.subset(np.flatnonzero(mask), folder+"/filtered")
+
+def integrity_test_files(folder: str, threshold: float, check, n_jobs: int = 1, batch_check=None) -> None:
+    """
+    Same as integrity_test_stage for a folder of single-frame XYZ files
+    """
+    files = glob.glob(folder+"/unfiltered/*.xyz")
     folder_out = folder+"/filtered"
+    mask = integrity_mask((next(tools.readFrames(file)) for file in tqdm.tqdm(files)), threshold, check,
+                          n_jobs, len(files), batch_check=batch_check)
+    for index in np.flatnonzero(mask):
+        shutil.copy(files[index], folder_out+"/"+files[index].split("/")[-1])
+
+def integrity_run(folder: str, threshold: float, check, n_jobs: int = 1, batch_check=None) -> None:
+    """
+    Filter folder/unfiltered into folder/filtered, whatever the stage format
+    """
+    if storage.open_source(folder+"/unfiltered") is not None:
+        integrity_test_stage(folder, threshold, check, n_jobs, batch_check)
+    else:
+        integrity_test_files(folder, threshold, check, n_jobs, batch_check)
+
+def integrity_test(folder: str, threshold: float, n_jobs: int = 1):
+    integrity_run(folder, threshold, is_connected, n_jobs)
 
-    for file in tqdm.tqdm(files):
-            # print("="*20)
-            # print("FILE: ", file)
-            mol=read(file)
-            cutOff = ase_n.natural_cutoffs(mol)
-            rmax = np.max(cutOff)
-            i, j, d = ase_n.neighbor_list('ijd', mol, rmax*2.0)
-            file_ok = True
-            for index_i, index_j, dist in zip(i, j, d):
-                # if index_i in [3,4,5]:
-                #     print(f"{index_i}:{index_j} - {cutOff[index_i]}+{cutOff[index_j]} -> {dist:.2f} Å")
-                if dist*threshold < (cutOff[index_i]+cutOff[index_j]):
-                    file_ok = False
-                    break
-            if file_ok:
-                shutil.copy(file,folder_out+"/"+file.split("/")[-1])
+def integrity_test_complexes_hpc(folder: str, threshold: float, n_jobs: int = -1):
+    start_time = time.time()
+    integrity_run(folder, threshold, has_no_clash, n_jobs, clash_free_chunk)
     end_time = time.time()
     print(f"\t\t\tExecution time: {end_time - start_time} seconds")
+
+
+def integrity_test_complexes(folder: str, threshold: float):
+    integrity_test_complexes_hpc(folder, threshold, 1)
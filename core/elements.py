@@ -0,0 +1,44 @@
+import os
+import numpy as np
+import numpy.typing as npt
+from ase.data import covalent_radii, atomic_masses
+
+
+def load_table(fname: str) -> tuple[list, npt.NDArray[int]]:
+    """
+    Read the species labels and atomic numbers listed in a mol.txt file
+    """
+    symbols = []
+    numbers = []
+    with open(fname) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 2:
+                symbols.append(fields[0])
+                numbers.append(int(fields[1]))
+    return symbols, np.array(numbers, dtype=int)
+
+# The user's mol.txt (next to main.py) takes precedence over the bundled one
+MOL_FILE = "mol.txt" if os.path.exists("mol.txt") else os.path.join(os.path.dirname(__file__), "mol.txt")
+
+SYMBOLS, NUMBERS = load_table(MOL_FILE)
+RADII = covalent_radii[NUMBERS]
+MASSES = atomic_masses[NUMBERS]
+
+# symbol -> integer code (row of NUMBERS/RADII/MASSES); first entry wins as in mol.txt scans
+CODES = {}
+for code, symbol in enumerate(SYMBOLS):
+    CODES.setdefault(symbol, code)
+
+
+def encode(symbols) -> npt.NDArray[int]:
+    """
+    Map a sequence of species labels to their integer codes
+    """
+    return np.array([CODES[symbol] for symbol in symbols], dtype=np.int16)
+
+def decode(codes) -> list:
+    """
+    Map integer codes back to species labels
+    """
+    return [SYMBOLS[code] for code in codes]
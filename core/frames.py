@@ -1,10 +1,10 @@
+from __future__ import annotations
 import numpy as np
 import math
 import tqdm
-from ase.data import atomic_numbers, atomic_names, atomic_masses, covalent_radii
-from ase.build import molecule
-from ase import Atoms
+from joblib import delayed, effective_n_jobs
 import core.tools as tools
+import core.elements as elements
 
 
 def check_constraint(d_0, cluster, pos, n_atoms, gamma):
@@ -25,57 +25,325 @@ def check_constraint(d_0, cluster, pos, n_atoms, gamma):
         return True
     return False
 
+def check_constraint_batch(d_0, cluster, candidates, gamma):
+    """
+    Vectorized check_constraint: evaluate a block of candidate positions
+    against the partial cluster at once and return the mask of valid ones
+    """
+    diff = candidates[:, np.newaxis, :] - cluster[np.newaxis, :, :]
+    min_dist = np.sqrt(np.einsum("ijk,ijk->ij", diff, diff)).min(axis=1)
+    return (min_dist >= 2.0 * (1.0 - gamma) * d_0) & (min_dist <= 2.0 * (1.0 + gamma) * d_0)
+
+class CellList:
+    """
+    Uniform grid over the box holding the atoms already placed
+
+    The cell edge is the largest allowed nearest-neighbour distance
+    (2*(1+gamma)*d_0), so any atom close enough to a candidate lies in one of
+    the 27 cells around it and the constraint check no longer grows with the
+    number of atoms placed
+    """
+
+    def __init__(self, half_width: float, cell: float, n_atoms: int, capacity: int = 4):
+        self.cell = cell
+        # one padding cell on each side keeps the 27 neighbours inside the grid
+        self.origin = -half_width - cell
+        dim = int(np.ceil(2.0*half_width/cell)) + 3
+        self.slots = np.full((dim, dim, dim, capacity), -1, dtype=int)
+        self.counts = np.zeros((dim, dim, dim), dtype=int)
+        # atoms in the 27 cells around each cell: candidates with none are rejected by a lookup
+        self.neighbours = np.zeros((dim, dim, dim), dtype=int)
+        self.positions = np.zeros((n_atoms, 3))
+        self.n_placed = 0
+        self.offsets = np.array([(i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)])
+
+    def index(self, pos):
+        idx = np.floor((pos - self.origin)/self.cell).astype(int)
+        return np.clip(idx, 1, self.counts.shape[0]-2)
+
+    def add(self, pos) -> None:
+        i, j, k = self.index(pos)
+        if self.counts[i, j, k] == self.slots.shape[3]:
+            extra = np.full(self.slots.shape[:3]+(self.slots.shape[3],), -1, dtype=int)
+            self.slots = np.concatenate((self.slots, extra), axis=3)
+        self.slots[i, j, k, self.counts[i, j, k]] = self.n_placed
+        self.counts[i, j, k] += 1
+        self.neighbours[i-1:i+2, j-1:j+2, k-1:k+2] += 1
+        self.positions[self.n_placed] = pos
+        self.n_placed += 1
+
+    def min_dist(self, candidates):
+        """
+        Distance from each candidate to the closest placed atom in the
+        neighbouring cells (inf when there is none)
+        """
+        min_dist = np.full(len(candidates), np.inf)
+        idx = self.index(candidates)
+        near = np.flatnonzero(self.neighbours[idx[:, 0], idx[:, 1], idx[:, 2]] > 0)
+        if len(near) == 0:
+            return min_dist
+        cells = idx[near, np.newaxis, :] + self.offsets[np.newaxis, :, :]
+        ids = self.slots[cells[..., 0], cells[..., 1], cells[..., 2]].reshape(len(near), -1)
+        diff = candidates[near, np.newaxis, :] - self.positions[ids]
+        dist = np.sqrt(np.einsum("ijk,ijk->ij", diff, diff))
+        dist[ids < 0] = np.inf
+        min_dist[near] = dist.min(axis=1)
+        return min_dist
+
+    def check(self, d_0, candidates, gamma):
+        """
+        Same result as check_constraint_batch against all the placed atoms
+        """
+        min_dist = self.min_dist(candidates)
+        return (min_dist >= 2.0 * (1.0 - gamma) * d_0) & (min_dist <= 2.0 * (1.0 + gamma) * d_0)
+
+def new_cell_list(box, d_0, n_atoms: int, gamma: float) -> CellList:
+    # candidates never leave [-box/2, box/2]^3 for either shape
+    return CellList(0.5*box, 2.0*(1.0 + gamma)*d_0, n_atoms)
+
+class SamplerStats:
+    """
+    Acceptance statistics of the adaptive sampler, per atom index:
+    proposals drawn and proposals that passed the distance constraints
+    """
+
+    def __init__(self, n_atoms: int):
+        self.proposed = np.zeros(n_atoms, dtype=np.int64)
+        self.accepted = np.zeros(n_atoms, dtype=np.int64)
+        self.restarts = 0
+        self.failed = 0
+
+    def merge(self, other: SamplerStats) -> None:
+        self.proposed += other.proposed
+        self.accepted += other.accepted
+        self.restarts += other.restarts
+        self.failed += other.failed
+
+    def report(self) -> None:
+        rate = self.accepted / np.maximum(self.proposed, 1)
+        worst = np.argsort(rate[1:])[:3] + 1
+        print(f"\t\t\tAcceptance rate: {self.accepted.sum()/max(self.proposed.sum(), 1):.4f} "
+              f"({self.accepted.sum()} of {self.proposed.sum()} proposals)")
+        print("\t\t\tLowest acceptance per atom index: " +
+              ", ".join(f"#{i}: {rate[i]:.4f}" for i in worst))
+        print(f"\t\t\tRestarted partial clusters: {self.restarts} - Abandoned structures: {self.failed}")
+
+def inside_box(shape, box, pos):
+    """
+    Positions within the region covered by random_positions
+    """
+    ok = np.all(np.abs(pos) <= 0.5*box, axis=1)
+    if shape=="SPHERE":
+        ok &= np.linalg.norm(pos, axis=1) <= box
+    return ok
+
+def random_positions(shape, box, size, rng=np.random):
+    """
+    Block of uniform candidate positions, same proposal as genSamples
+    """
+    pos = box*(rng.random((size, 3))-0.5)
+    if shape=="SPHERE":
+        pos = pos[np.linalg.norm(pos, axis=1) <= box]
+    return pos
+
+def gen_cluster_serial(shape, box, d_0, n_atoms: int, gamma: float, rng=np.random,
+                       spatial_index: bool = False):
+    cells = new_cell_list(box, d_0, n_atoms, gamma) if spatial_index else None
+    cluster=[]
+    for i in range(n_atoms):
+        ok = False
+        while not ok:
+            pos=box*(rng.random(3)-np.ones(3)*0.5)
+            if shape=="SPHERE":
+                while np.linalg.norm(np.zeros(3)-pos)>box:
+                    pos=box*(rng.random(3)-np.ones(3)*0.5)
+            if i==0:
+                ok = True
+            elif cells is not None:
+                ok = cells.check(d_0, pos[np.newaxis], gamma)[0]
+            else:
+                ok = check_constraint(d_0, cluster, pos, n_atoms, gamma)
+        cluster.append(pos)
+        if cells is not None:
+            cells.add(pos)
+    return np.array(cluster)
+
+def gen_cluster_batch(shape, box, d_0, n_atoms: int, gamma: float, rng=np.random,
+                      spatial_index: bool = False, block: int = 256):
+    """
+    Build a cluster drawing `block` candidates at a time for each atom;
+    the first candidate satisfying the constraint is accepted
+    """
+    cells = new_cell_list(box, d_0, n_atoms, gamma) if spatial_index else None
+    cluster = np.zeros((n_atoms, 3))
+    for i in range(n_atoms):
+        ok = np.zeros(0, dtype=bool)
+        while not ok.any():
+            candidates = random_positions(shape, box, block, rng)
+            if i==0:
+                ok = np.ones(len(candidates), dtype=bool)
+            elif cells is not None:
+                ok = cells.check(d_0, candidates, gamma)
+            else:
+                ok = check_constraint_batch(d_0, cluster[:i], candidates, gamma)
+        cluster[i] = candidates[np.argmax(ok)]
+        if cells is not None:
+            cells.add(cluster[i])
+    return cluster
+
+def gen_cluster_adaptive(shape, box, d_0, n_atoms: int, gamma: float, rng=np.random,
+                         spatial_index: bool = False, stats: SamplerStats = None,
+                         max_attempts: int = 100000, max_restarts: int = 100,
+                         block: int = 64, saturation: int = 512):
+    """
+    Build a cluster proposing each new atom in the allowed shell
+    [(1-gamma)*2d_0, (1+gamma)*2d_0] around an atom already placed (anchor)
+    instead of anywhere in the box. Anchors whose shell keeps failing
+    (`saturation` proposals) are dropped; when no anchor is left or an atom
+    exceeds `max_attempts` proposals the partial cluster is restarted, and
+    the structure is abandoned (None) after `max_restarts` restarts
+    """
+    stats = SamplerStats(n_atoms) if stats is None else stats
+    rmin = 2.0 * (1.0 - gamma) * d_0
+    rmax = 2.0 * (1.0 + gamma) * d_0
+
+    for restart in range(max_restarts+1):
+        cells = new_cell_list(box, d_0, n_atoms, gamma) if spatial_index else None
+        cluster = np.zeros((n_atoms, 3))
+        candidates = np.zeros((0, 3))
+        while len(candidates) == 0:
+            candidates = random_positions(shape, box, 1, rng)
+        cluster[0] = candidates[0]
+        stats.proposed[0] += 1
+        stats.accepted[0] += 1
+        if cells is not None:
+            cells.add(cluster[0])
+
+        for i in range(1, n_atoms):
+            fails = np.zeros(i, dtype=np.int64)
+            attempts = 0
+            placed = False
+            while attempts < max_attempts and np.any(fails < saturation):
+                anchors = rng.choice(np.flatnonzero(fails < saturation), block)
+                direction = rng.normal(size=(block, 3))
+                direction /= np.linalg.norm(direction, axis=1)[:, np.newaxis]
+                radius = (rmin**3 + rng.random(block)*(rmax**3 - rmin**3))**(1.0/3.0) # uniform in the shell volume
+                candidates = cluster[anchors] + direction*radius[:, np.newaxis]
+                attempts += block
+                stats.proposed[i] += block
+
+                ok = inside_box(shape, box, candidates)
+                if ok.any():
+                    if cells is not None:
+                        ok[ok] = cells.check(d_0, candidates[ok], gamma)
+                    else:
+                        ok[ok] = check_constraint_batch(d_0, cluster[:i], candidates[ok], gamma)
+                stats.accepted[i] += np.count_nonzero(ok)
+                if ok.any():
+                    cluster[i] = candidates[np.argmax(ok)]
+                    placed = True
+                    break
+                fails += np.bincount(anchors, minlength=i)
+
+            if not placed:
+                break
+            if cells is not None:
+                cells.add(cluster[i])
+        else:
+            return cluster
+        stats.restarts += 1
+
+    stats.failed += 1
+    return None
+
+def gen_cluster(sampler, shape, box, d_0, n_atoms: int, gamma: float, rng=np.random,
+                spatial_index: bool = False, stats: SamplerStats = None, **budget):
+    if sampler=="ADAPTIVE":
+        return gen_cluster_adaptive(shape, box, d_0, n_atoms, gamma, rng, spatial_index, stats, **budget)
+    if sampler=="BATCH":
+        return gen_cluster_batch(shape, box, d_0, n_atoms, gamma, rng, spatial_index)
+    return gen_cluster_serial(shape, box, d_0, n_atoms, gamma, rng, spatial_index)
+
+def gen_cluster_chunk(seeds, sampler, shape, box, d_0, n_atoms: int, gamma: float,
+                      spatial_index: bool = False, **budget):
+    """
+    Worker task: one cluster per seed, each from its own random stream
+    """
+    stats = SamplerStats(n_atoms)
+    clusters = [gen_cluster(sampler, shape, box, d_0, n_atoms, gamma, np.random.default_rng(seed),
+                            spatial_index, stats, **budget)
+                for seed in seeds]
+    return clusters, stats
+
 def genSamples(n_structures, shape, atom, n_atoms: int, 
                factor: float,
                gamma: float, 
-               folder: str):
+               folder: str,
+               sampler: str = "SERIAL",
+               n_jobs: int = 1,
+               seed = None,
+               spatial_index: bool = False,
+               **budget):
+    """
+    sampler - "SERIAL" places one candidate at a time, "BATCH" evaluates
+              blocks of candidates with array operations, "ADAPTIVE"
+              proposes candidates in the allowed shell around placed atoms,
+              restarts stalled clusters and reports acceptance statistics
+    n_jobs  - number of worker processes
+    seed    - master seed; every structure gets its own stream spawned from
+              (seed, atom, shape), so the frames do not depend on how they
+              are distributed. Without seed and with n_jobs=1 the global
+              np.random state is used
+    spatial_index - check candidates only against the neighbouring cells
+              of a cell list of the placed atoms (same result, for large clusters)
+    budget  - max_attempts (proposals per atom) and max_restarts of the adaptive sampler
+    """
     print(f"\t\t\tBOX: {shape}")
-    clusters_list=[]
-    d_0=1.0*covalent_radii[atomic_numbers[atom]]
+    d_0=1.0*elements.RADII[elements.CODES[atom]]
 
     # This radius comes from http://dx.doi.org/10.1016/S0166-1280(01)00730-8
     sphere_radius =  2.0* d_0 * (factor + math.pow((3.0*n_atoms)/(4.0*np.pi*math.sqrt(2.0)), (1.0/3.0)))
 
-    for n in tqdm.tqdm(range(n_structures)):
-        if shape=="CUBE":
-            tc = "RC"
-            # box = 2.0 * d_0 * math.pow(n_atoms, (1.0 / 3.0))
-            box = sphere_radius*math.pow(4.0*np.pi/3.0, (1.0/3.0))
-            # print("CUBE: ", box)
-            cluster=[]
-            for i in range(n_atoms):
-                ok = False
-                while not ok:
-                    pos=box*(np.random.rand(3)-np.ones(3)*0.5)
-                    if i==0:
-                        ok = True
-                    else:
-                        ok = check_constraint(d_0, cluster, pos, n_atoms, gamma)
-                cluster.append(pos)
-
-        if shape=="SPHERE":
-            tc = "RS"
-            # This radius comes from http://dx.doi.org/10.1016/S0166-1280(01)00730-8
-            box = sphere_radius
-            # print("SPHERE: ", box)
-            cluster=[]
-            for i in range(n_atoms):
-                ok = False
-                while not ok:
-                    pos=box*(np.random.rand(3)-np.ones(3)*0.5)
-                    while np.linalg.norm(np.zeros(3)-pos)>box:
-                        pos=box*(np.random.rand(3)-np.ones(3)*0.5)
-                    if i==0:
-                        ok = True
-                    else:
-                        ok = check_constraint(d_0, cluster, pos, n_atoms, gamma)
-                cluster.append(pos)
+    if shape=="CUBE":
+        tc = "RC"
+        # box = 2.0 * d_0 * math.pow(n_atoms, (1.0 / 3.0))
+        box = sphere_radius*math.pow(4.0*np.pi/3.0, (1.0/3.0))
+    if shape=="SPHERE":
+        tc = "RS"
+        # This radius comes from http://dx.doi.org/10.1016/S0166-1280(01)00730-8
+        box = sphere_radius
+
+    stats = SamplerStats(n_atoms)
+    if n_jobs == 1 and seed is None:
+        clusters = (gen_cluster(sampler, shape, box, d_0, n_atoms, gamma,
+                                spatial_index=spatial_index, stats=stats, **budget)
+                    for n in range(n_structures))
+    else:
+        seed = np.random.SeedSequence(seed, spawn_key=(elements.CODES[atom], ("CUBE", "SPHERE").index(shape)))
+        seeds = seed.spawn(n_structures)
+        # a few chunks per worker to balance the load while amortising the dispatch,
+        # sent a wave at a time when a streaming target may stop the generation
+        size = max(1, min(tools.PARALLEL_CHUNK, math.ceil(n_structures/(4*effective_n_jobs(n_jobs)))))
+        tasks = (delayed(gen_cluster_chunk)(seeds[start:start+size], sampler, shape, box, d_0, n_atoms, gamma,
+                                            spatial_index, **budget)
+                 for start in range(0, n_structures, size))
 
-        structure = Atoms(atom+str(n_atoms), positions=cluster)
+        def collect():
+            for chunk, chunk_stats in tools.parallel_waves(n_jobs, tasks, tools.target_reached(folder)):
+                stats.merge(chunk_stats)
+                yield from chunk
+        clusters = collect()
 
+    for n, cluster in enumerate(tqdm.tqdm(clusters, total=n_structures)):
+        if getattr(folder, "done", False): # streaming filter reached its target
+            break
+        if cluster is None:
+            continue
         fname = f"{tc}_{atom}{n_atoms}_F{n}"
-        list_atoms = structure.get_chemical_symbols()
-        list_coords = structure.get_positions()
+        list_atoms = [atom]*n_atoms
+        list_coords = np.array(cluster)
         # energyI = structure.get_potential_energy()
-        tools.generateXYZ(list_atoms, list_coords, 0.0, fname, folder)
+        tools.generateXYZ(list_atoms, list_coords, 0.0, fname, folder, sample=n)
 
+    if sampler=="ADAPTIVE":
+        stats.report()
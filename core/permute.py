@@ -1,69 +1,308 @@
 import itertools
+import math
 import os
 import glob
 from ase import Atoms
 # from dscribe.descriptors import CoulombMatrix
 from sklearn.preprocessing import StandardScaler
+from scipy.spatial import cKDTree
 import tqdm
 import numpy as np
 import random
 
 import core.tools as tools
+import core.elements as elements
 import core.representatives as rep
 import core.connectivity as net
 
-def get_templates(params: dict) -> list:
+from joblib import delayed, effective_n_jobs
+
+# rounds of the Feistel permutation drawing the ranks of the homotops
+FEISTEL_ROUNDS = 8
+
+# largest order of a finite point group (icosahedral, Ih): a set of
+# operations closing to more is not a point group of the frame
+MAX_GROUP_ORDER = 120
+
+def count_templates(params: dict) -> int:
+    """
+    Number of ways to place NUMELEM1 atoms on the frame positions
+    """
     natoms = params["NUMELEM1"]+params["NUMELEM2"]
-    combinations = itertools.combinations(range(natoms), params["NUMELEM1"])
-    return list(combinations)
+    return math.comb(natoms, params["NUMELEM1"])
 
-def gen_permutations(params: dict, files: str) -> None:
+def unrank_combination(rank: int, n: int, k: int) -> tuple:
+    """
+    Combination at position `rank` of itertools.combinations(range(n), k)
+    (combinatorial number system, lexicographic order)
+    """
+    combination = []
+    item = 0
+    for slot in range(k):
+        while True:
+            count = math.comb(n - item - 1, k - slot - 1) # combinations starting with item
+            if rank < count:
+                break
+            rank -= count
+            item += 1
+        combination.append(item)
+        item += 1
+    return tuple(combination)
+
+def mix64(x: int) -> int:
+    """
+    SplitMix64 finaliser: a well-spread 64-bit hash of an integer
+    """
+    x = (x * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return x ^ (x >> 31)
+
+def random_ranks(total: int, rng=random):
+    """
+    Distinct ranks in [0, total) in random order, drawn lazily in O(1)
+    memory: a keyed Feistel permutation of the smallest domain of 4^h
+    values covering total, cycle-walking past the values >= total
+    """
+    if total <= 0:
+        return
+    half = max(1, ((total - 1).bit_length() + 1) // 2)
+    mask = (1 << half) - 1
+    keys = [rng.getrandbits(64) for _ in range(FEISTEL_ROUNDS)]
+
+    def permute(x: int) -> int:
+        left, right = x >> half, x & mask
+        for key in keys:
+            left, right = right, left ^ (mix64(right ^ key) & mask)
+        return (left << half) | right
+
+    for index in range(total):
+        rank = permute(index)
+        while rank >= total: # cycle-walking stays a bijection of [0, total)
+            rank = permute(rank)
+        yield rank
+
+def fit_operation(x: np.ndarray, perm) -> np.ndarray:
+    """
+    Orthogonal map (proper or improper) taking the atoms x closest, in
+    least squares, onto the atoms they are matched to, x[perm] (Kabsch)
+    """
+    u, _, vt = np.linalg.svd(x[perm].T @ x)
+    return u @ vt
+
+def close_group(perms: set, natoms: int) -> set:
+    """
+    Closure of a set of atom permutations under composition, or None if
+    it grows past MAX_GROUP_ORDER
+    """
+    group = set(perms) | {tuple(range(natoms))}
+    generators = np.array(sorted(group))
+    frontier = generators
+    while len(frontier):
+        # product[f, g] = frontier[f] composed with generators[g]
+        products = map(tuple, frontier[:, generators].reshape(-1, natoms).tolist())
+        grown = [perm for perm in set(products) if perm not in group]
+        group.update(grown)
+        if len(group) > MAX_GROUP_ORDER:
+            return None
+        frontier = np.array(grown, dtype=int).reshape(-1, natoms)
+    return group
+
+def symmetry_permutations(codes, coords, tol: float = 0.01) -> np.ndarray:
+    """
+    Point-group operations of a frame as atom permutations (G, natoms):
+    row g maps atom i onto atom perm[g, i]. A candidate operation is
+    guessed from two reference atoms (and their cross product, with either
+    sign for improper operations) mapped onto atoms with the same species,
+    distance to the centroid and separation, then refitted by least
+    squares over all the atoms it matches (fit_operation); it is kept if
+    the refitted map takes every atom onto an atom of the same species
+    within `tol`. The kept operations are closed under composition, so
+    that operations missed to the positional noise are recovered and the
+    result is a group (the identity alone if the closure is no point group)
+    """
+    codes = np.asarray(codes)
+    natoms = len(codes)
+    x = coords - np.mean(coords, axis=0)
+    r = np.linalg.norm(x, axis=1)
+    identity = np.arange(natoms)[np.newaxis]
+
+    off_centre = np.flatnonzero(r > tol)
+    if len(off_centre) == 0:
+        return identity
+    a = off_centre[np.argmax(r[off_centre])]
+    spread = np.linalg.norm(np.cross(x[a], x), axis=1)
+    if spread.max() <= tol*r[a]:
+        return identity # linear structure
+    b = np.argmax(spread) # best-conditioned reference pair
+    frame = np.array([x[a], x[b], np.cross(x[a], x[b])])
+    d_ab = np.linalg.norm(x[a] - x[b])
+
+    tree = cKDTree(x)
+    perms = set()
+    # the reference atoms are screened loosely: the final test is the refitted map
+    images_a = np.flatnonzero((codes == codes[a]) & (np.abs(r - r[a]) < 2*tol))
+    images_b = np.flatnonzero((codes == codes[b]) & (np.abs(r - r[b]) < 2*tol))
+    for ia in images_a:
+        for ib in images_b:
+            if ia == ib or abs(np.linalg.norm(x[ia] - x[ib]) - d_ab) > 2*tol:
+                continue
+            for sign in (1.0, -1.0):
+                image = np.array([x[ia], x[ib], sign*np.cross(x[ia], x[ib])])
+                u, _, vt = np.linalg.svd(image.T @ frame) # nearest orthogonal map
+                _, perm = tree.query(x @ (u @ vt).T)
+                if np.any(codes[perm] != codes) or len(np.unique(perm)) != natoms:
+                    continue
+                dist, refit = tree.query(x @ fit_operation(x, perm).T, distance_upper_bound=tol)
+                if np.all(np.isfinite(dist)) and np.all(refit == perm):
+                    perms.add(tuple(perm))
+    group = close_group(perms, natoms)
+    if group is None:
+        return identity
+    return np.array(sorted(group))
+
+def count_homotops(perms: np.ndarray, natoms1: int) -> int:
+    """
+    Number of symmetry-distinct ways to place natoms1 atoms of the first
+    species (Burnside): mean over the operations of the x^natoms1
+    coefficient of prod over cycles of (1 + x^cycle_length)
+    """
+    total = 0
+    for perm in perms:
+        seen = np.zeros(len(perm), dtype=bool)
+        poly = [1] + [0]*natoms1
+        for start in range(len(perm)):
+            if seen[start]:
+                continue
+            length = 0
+            atom = start
+            while not seen[atom]:
+                seen[atom] = True
+                atom = perm[atom]
+                length += 1
+            poly = [poly[k] + (poly[k-length] if k >= length else 0) for k in range(natoms1+1)]
+        total += poly[natoms1]
+    return total // len(perms)
+
+def canonical_homotop(perms: np.ndarray, combination) -> tuple:
+    """
+    Representative of the symmetry orbit of a combination: the smallest of
+    its images (sorted positions of the first species) under the operations
+    """
+    images = np.sort(perms[:, list(combination)], axis=1)
+    return min(map(tuple, images.tolist()))
+
+def sample_homotops(params: dict, codes, coords, rng=random, np_seed=None) -> tuple:
+    """
+    Draw the cores of one frame: up to MAX_GEN_PER_FRAME random homotops
+    (symmetry-distinct ones with SYMMETRY), reduced to representatives by
+    k-means with PRE_SELECTION (all kept when too few for the KMEANS range)
+    rng     - source of the permutation draws (the global random module by default)
+    np_seed - seed of a local RandomState for the PRE_SELECTION clustering,
+              if given (the global np.random state otherwise)
+    Returns the ranks (permutation ids) of the homotops drawn, the indices
+    of those to write, the number of distinct homotops and the number of
+    symmetry operations of the frame (None, 1 without SYMMETRY)
+    """
+    natoms = params["NUMELEM1"]+params["NUMELEM2"]
+    maxgen_frame = params["MOD2"]["MAX_GEN_PER_FRAME"]
+    pre_selection = params["MOD2"]["PRE_SELECTION"]
+    symmetry = params["MOD2"].get("SYMMETRY", False)
+
+    distinct = None
+    order = 1
+    if symmetry:
+        perms = symmetry_permutations(codes, coords, params["MOD2"].get("SYMMETRY_TOL", 0.01))
+        distinct = count_homotops(perms, params["NUMELEM1"])
+        order = len(perms)
+        seen = set()
+
+    ranks = []
+    for rank in random_ranks(count_templates(params), rng):
+        if len(ranks) >= maxgen_frame:
+            break
+        if symmetry:
+            canonical = canonical_homotop(perms, unrank_combination(rank, natoms, params["NUMELEM1"]))
+            if canonical in seen: # equivalent to a core already drawn from this frame
+                continue
+            seen.add(canonical)
+        ranks.append(rank)
+
+    indices = list(range(len(ranks)))
+    if pre_selection and len(params["MOD2"]["KMEANS"]) > 1 \
+       and len(rep.k_values(params["MOD2"]["KMEANS"], len(ranks))) == 0:
+        pre_selection = False # too few homotops for the K search: all of them are kept
+    if pre_selection and ranks:
+        np_rng = np.random if np_seed is None else np.random.RandomState(np_seed)
+        # all homotops of the frame share its coordinates: only the charges change
+        charges = np.full((len(ranks), natoms), elements.NUMBERS[elements.CODES[params["ELEM2"]]])
+        for row, rank in enumerate(ranks):
+            charges[row, list(unrank_combination(rank, natoms, params["NUMELEM1"]))] = \
+                elements.NUMBERS[elements.CODES[params["ELEM1"]]]
+        coulomb = tools.eigenCoulombHomotops(coords, charges)
+        coulomb = StandardScaler().fit_transform(coulomb)
+        indices = rep.get_representatives(params["MOD2"], coulomb, [None]*len(ranks), indices, np_rng)
+    return ranks, indices, distinct, order
+
+def sample_homotops_chunk(params: dict, frames: list, seeds: list) -> list:
+    """
+    Worker task: sample_homotops for a list of (codes, coords), each frame
+    with its own random streams
+    """
+    results = []
+    for (codes, coords), seed in zip(frames, seeds):
+        py_state, np_state = seed.generate_state(2)
+        results.append(sample_homotops(params, codes, coords, random.Random(int(py_state)), np_state))
+    return results
+
+def gen_permutations(params: dict, frames: list, outfolder=None, n_jobs: int = 1, seed=None) -> None:
     """
     Generate all permutations of the alloys
+    frames    - list of (name, codes, coords, energy), as tools.readFrames
+    outfolder - output folder or archive (defaults to TMP_FOLDER/unfiltered/)
+    n_jobs    - worker processes; frames are sampled in parallel and written
+                by the parent in input order
+    seed      - master seed; every frame gets its own streams spawned from
+                it, so the cores do not depend on n_jobs. Without seed and
+                with n_jobs=1 the global random states are used
     """
     atom1 = params["ELEM1"]
     atom2 = params["ELEM2"]
     natoms = params["NUMELEM1"]+params["NUMELEM2"]
-    outfolder = params["MOD2"]["TMP_FOLDER"]+"/unfiltered/"
-    maxgen_frame = params["MOD2"]["MAX_GEN_PER_FRAME"]
-    pre_selection = params["MOD2"]["PRE_SELECTION"]
-        # "RUN_MOD_ZERO": false,
-
-    combinations = list(itertools.combinations(range(natoms), params["NUMELEM1"]))
-    ids_combinations = list(range(len(combinations)))
-
-    for file in tqdm.tqdm(files, desc='Processing Frames', position=0):
-        pfiles = []
-        X = []
-        list_coords = []
-        list_atoms = []
-        coulomb = []
-        base_name = os.path.basename(file)
-        base_name = os.path.splitext(base_name)[0]
-        natoms, atomtypes, coords, energy = tools.xyzRead(file)
-        random.shuffle(ids_combinations)
-
-        for index, id_combination in enumerate(ids_combinations):
-            if index < maxgen_frame:
-                for id_atom in range(len(atomtypes)):
-                    if id_atom in combinations[id_combination]:
-                        atomtypes[id_atom] = atom1
-                    else:
-                        atomtypes[id_atom] = atom2
-                pfile = base_name+"_P"+str(index)
-                if pre_selection:
-                    pfiles.append(pfile[:])
-                    list_coords.append(coords[:])
-                    list_atoms.append(atomtypes)
-                    coulomb.append(tools.eigenCoulomb(natoms, list_atoms[index], coords))
-                else:
-                    tools.generateXYZ(atomtypes, coords, 0.0, pfile, outfolder)
-
-        if pre_selection:
-            coulomb = np.array(coulomb)
-            coulomb = StandardScaler().fit_transform(coulomb)
-            sel_samples = rep.get_representatives(params["MOD2"], coulomb, pfiles)
-
-            for idx in sel_samples:
-                tools.generateXYZ(list_atoms[idx], list_coords[idx], 0.0, pfiles[idx], outfolder)
+    if outfolder is None:
+        outfolder = params["MOD2"]["TMP_FOLDER"]+"/unfiltered/"
+
+    if n_jobs == 1 and seed is None:
+        results = (sample_homotops(params, codes, coords) for _, codes, coords, _ in frames)
+    else:
+        seeds = np.random.SeedSequence(seed).spawn(len(frames))
+        # sent a wave at a time when a streaming target may stop the sampling
+        size = max(1, min(tools.PARALLEL_CHUNK, math.ceil(len(frames)/(4*effective_n_jobs(n_jobs)))))
+        tasks = (delayed(sample_homotops_chunk)(params, [(codes, coords) for _, codes, coords, _ in frames[start:start+size]],
+                                                seeds[start:start+size])
+                 for start in range(0, len(frames), size))
+        results = (result for chunk in tools.parallel_waves(n_jobs, tasks, tools.target_reached(outfolder))
+                   for result in chunk)
+
+    distinct = []
+    group_orders = []
+    for (base_name, codes, coords, energy), (ranks, indices, n_distinct, order) in \
+            zip(tqdm.tqdm(frames, desc='Processing Frames', position=0), results):
+        distinct.append(n_distinct)
+        group_orders.append(order)
+        for index in indices:
+            if getattr(outfolder, "done", False): # streaming filter reached its target
+                break
+            combination = unrank_combination(ranks[index], natoms, params["NUMELEM1"])
+            atomtypes = [atom2]*natoms
+            for id_atom in combination:
+                atomtypes[id_atom] = atom1
+            tools.generateXYZ(atomtypes, coords, 0.0, base_name+"_P"+str(index), outfolder,
+                              source=base_name, permutation=ranks[index])
+        if getattr(outfolder, "done", False):
+            break
 
+    if params["MOD2"].get("SYMMETRY", False):
+        print(f"\t\t\tSymmetry-distinct homotops per frame: {min(distinct)} to {max(distinct)} "
+              f"(total {sum(distinct)}); frames with symmetry: "
+              f"{sum(order > 1 for order in group_orders)} of {len(group_orders)}")
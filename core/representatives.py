@@ -2,82 +2,369 @@ import numpy as np
 import numpy.typing as npt
 import tqdm
 import sys
-from sklearn.metrics import silhouette_score
-from sklearn.metrics import silhouette_samples
-from sklearn.cluster import KMeans
+from sklearn.metrics import pairwise_distances
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.preprocessing import StandardScaler
+from scipy.spatial import cKDTree
+from joblib import Parallel, delayed, effective_n_jobs, cpu_count
+from threadpoolctl import threadpool_limits
 
 # local
 from core.cluster import Cluster
 import core.tools as tools
 
 
+# memory allowed for the cached pairwise distances of the K search, and
+# size of the blocks in which they are computed and read back
+DISTANCE_CACHE_BYTES = 1 << 30
+DISTANCE_BLOCK_BYTES = 64 << 20
+
+# streamed (MINIBATCH) selection: rows read at a time, passes (in random
+# batches) of the mini-batch fit and size of the subsample used to search K
+STREAM_CHUNK = 4096
+STREAM_EPOCHS = 3
+STREAM_SEARCH_SAMPLE = 10000
+
+# default subsample size of the "SAMPLED" silhouette
+SILHOUETTE_SAMPLE = 2000
+
+# consecutive values of K scoring below the best before the "SWEEP" search stops
+PATIENCE = 3
+
+
+class DistanceCache:
+    """
+    Pairwise Euclidean distances of the descriptors, computed once and
+    shared by every silhouette evaluation of the K search. The matrix is
+    kept in memory in float64 when it fits in `max_bytes`, otherwise in
+    float32; beyond that (above about 16000 samples) nothing is cached and
+    every pass recomputes the distances block by block, so that memory
+    stays bounded by one block. Blocks are read back in float64
+    """
+
+    def __init__(self, data: npt.NDArray[float], max_bytes: int = DISTANCE_CACHE_BYTES):
+        n = len(data)
+        self.data = data
+        if 8*n*n <= max_bytes:
+            self.matrix = pairwise_distances(data)
+            self.block = max(1, n)
+            return
+        self.block = max(1, int(DISTANCE_BLOCK_BYTES // (8*n)))
+        if 4*n*n > max_bytes:
+            self.matrix = None
+            return
+        self.matrix = np.empty((n, n), dtype=np.float32)
+        for start in range(0, n, self.block):
+            self.matrix[start:start+self.block] = pairwise_distances(data[start:start+self.block], data)
+
+    def blocks(self):
+        """
+        Yield (first row, distances of the rows to all samples)
+        """
+        for start in range(0, len(self.data), self.block):
+            if self.matrix is None:
+                yield start, pairwise_distances(self.data[start:start+self.block], self.data)
+            else:
+                yield start, np.asarray(self.matrix[start:start+self.block], dtype=np.float64)
+
+
+def silhouette_values(distances: DistanceCache, labels: npt.NDArray[int]) -> npt.NDArray[float]:
+    """
+    Silhouette of each sample (as sklearn's silhouette_samples) from the
+    shared distances: per-cluster distance sums are one product of each
+    distance block with the cluster indicator matrix
+    """
+    _, labels = np.unique(labels, return_inverse=True)
+    sizes = np.bincount(labels)
+    indicator = np.zeros((len(labels), len(sizes)))
+    indicator[np.arange(len(labels)), labels] = 1.0
+
+    values = np.empty(len(labels))
+    for start, block in distances.blocks():
+        own = labels[start:start+len(block)]
+        rows = np.arange(len(block))
+        sums = block @ indicator
+        intra = sums[rows, own] / np.maximum(sizes[own] - 1, 1)
+        sums[rows, own] = np.inf
+        inter = np.min(sums / sizes, axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            silh = (inter - intra) / np.maximum(intra, inter)
+        silh[sizes[own] == 1] = 0.0 # singleton clusters
+        values[start:start+len(block)] = np.nan_to_num(silh)
+    return values
+
+
+def simplified_silhouette_values(data: npt.NDArray[float], labels: npt.NDArray[int],
+                                 centroids: npt.NDArray[float]) -> npt.NDArray[float]:
+    """
+    Centroid-based (simplified) silhouette of each sample: distances to the
+    own and to the nearest other centroid replace the mean distances to
+    the members, O(n*k) instead of O(n^2)
+    """
+    dist = pairwise_distances(data, centroids)
+    rows = np.arange(len(data))
+    intra = dist[rows, labels]
+    dist[rows, labels] = np.inf
+    inter = np.min(dist, axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.nan_to_num((inter - intra) / np.maximum(intra, inter))
+
+
+def stratified_sample(labels: npt.NDArray[int], size: int, seed: int) -> npt.NDArray[int]:
+    """
+    Indices of about `size` samples drawn from every cluster in proportion
+    to its size (at least one per cluster)
+    """
+    rng = np.random.default_rng(seed)
+    indices = []
+    for cluster in np.unique(labels):
+        members = np.flatnonzero(labels == cluster)
+        quota = max(1, int(round(size*len(members)/len(labels))))
+        indices.append(rng.choice(members, min(quota, len(members)), replace=False))
+    return np.sort(np.concatenate(indices))
+
+
+def silhouette_criterion(labels: npt.NDArray[int], silh_samples: npt.NDArray[float], k: int) -> float:
+    """
+    (#clusters whose mean silhouette reaches the general Silhouette) / (#clusters)
+    """
+    # General silhouette is the mean over the samples
+    silh_score = silh_samples.mean()
+
+    # Group silhouette scores belonging in the same cluster together
+    _, labels = np.unique(labels, return_inverse=True)
+    groups = np.bincount(labels, weights=silh_samples) / np.bincount(labels)
+
+    # Return (#clusters that surpassed the general Silhouette) / (#clusters)
+    return np.sum(groups >= silh_score) / k
+
+
 # Implemented by Felipe V. Calderan
 def calculate_silhouette(
-    data: npt.NDArray[float], labels: npt.NDArray[int], k: int
+    data: npt.NDArray[float], labels: npt.NDArray[int], k: int,
+    distances: DistanceCache = None
 ) -> float:
     """
     Compute Silhouette for each sample, take the average for each cluster and
     return (#clusters that surpassed the general Silhouette) / (#clusters)
+    distances - pairwise distances of data, reused across calls
     """
+    if distances is None:
+        distances = DistanceCache(data)
     # Calculate silhouette for individual samples
-    silh_samples = silhouette_samples(data, labels)
-    # Calculate general silhouette
-    silh_score = silhouette_score(data, labels)
+    return silhouette_criterion(labels, silhouette_values(distances, labels), k)
 
-    # Create cluster-silhouette array and order it by label number
-    csilh = np.array(list(zip(labels, silh_samples)))
-    csilh = csilh[csilh[:, 0].argsort()]
 
-    # Group silhouette scores belonging in the same cluster together
-    groups = np.split(
-        csilh[:, 1], np.unique(csilh[:, 0], return_index=True)[1][1:]
-    )
+def fit_clustering(data: npt.NDArray[float], k: int, seed: int, runs: int,
+                   distances: DistanceCache, method: str = "EXACT",
+                   sample_size: int = SILHOUETTE_SAMPLE,
+                   init: npt.NDArray[float] = None) -> tuple:
+    """
+    One K-Means fit of the K search, scored by the silhouette criterion of
+    calculate_silhouette over all samples ("EXACT"), over a stratified
+    subsample of `sample_size` samples ("SAMPLED") or with the
+    centroid-based simplified silhouette ("SIMPLIFIED")
+    init - initial centroids, one more run next to the `runs` random ones
+           (the lowest WCSS is kept, as within KMeans)
+    Returns (int32 labels, centroids, score, wcss)
+    """
+    kmeans = KMeans(n_clusters=k, n_init=runs, random_state=seed).fit(data)
+    if init is not None:
+        warm = KMeans(n_clusters=k, init=init, n_init=1, random_state=seed).fit(data)
+        if warm.inertia_ < kmeans.inertia_:
+            kmeans = warm
+    labels = kmeans.labels_.astype(np.int32, copy=False)
+    if method == "SIMPLIFIED":
+        score = silhouette_criterion(labels, simplified_silhouette_values(data, labels, kmeans.cluster_centers_), k)
+    elif method == "SAMPLED" and sample_size < len(data):
+        sample = stratified_sample(labels, sample_size, seed)
+        score = calculate_silhouette(data[sample], labels[sample], k)
+    else:
+        score = calculate_silhouette(data, labels, k, distances)
+    return labels, kmeans.cluster_centers_, score, kmeans.inertia_
 
-    # Return (#clusters that surpassed the general Silhouette) / (#clusters)
-    return sum([group.mean() >= silh_score for group in groups]) / k
+
+def split_worst_cluster(data: npt.NDArray[float], centroids: npt.NDArray[float], seed: int,
+                        splits: int = 1) -> npt.NDArray[float]:
+    """
+    Initial centroids for K+splits from the centroids of a K solution: the
+    cluster with the largest sum of squared distances is split in two by a
+    2-means on its members, `splits` times. None if no cluster can be split
+    """
+    labels = np.argmin(pairwise_distances(data, centroids), axis=1)
+    centroids = list(centroids)
+    for _ in range(splits):
+        sse = np.bincount(labels, weights=np.sum((data - np.array(centroids)[labels])**2, axis=1),
+                          minlength=len(centroids))
+        worst = int(np.argmax(sse))
+        members = np.flatnonzero(labels == worst)
+        if sse[worst] == 0 or len(members) < 2:
+            return None
+        halves = KMeans(n_clusters=2, n_init=1, random_state=seed).fit(data[members])
+        centroids[worst] = halves.cluster_centers_[0]
+        centroids.append(halves.cluster_centers_[1])
+        labels[members[halves.labels_ == 1]] = len(centroids) - 1
+    return np.array(centroids)
+
+
+def fit_clustering_limited(threads: int, *args) -> tuple:
+    """
+    fit_clustering with the native (OpenMP/BLAS) pools limited to `threads`;
+    entered in the worker thread, since OpenMP limits are per thread
+    """
+    with threadpool_limits(limits=threads):
+        return fit_clustering(*args)
+
+
+def fit_batch(tasks: list, data: npt.NDArray[float], runs: int, distances: DistanceCache,
+              method: str, sample_size: int, n_jobs: int, backend: str, progress) -> list:
+    """
+    fit_clustering for a list of (k, seed, init) on n_jobs workers (see
+    perform_clustering_n_random); the results keep the order of the tasks
+    """
+    def tracked():
+        for task in tasks:
+            yield task
+            progress.update()
+
+    workers = effective_n_jobs(n_jobs)
+    if workers == 1:
+        return [fit_clustering(data, k, seed, runs, distances, method, sample_size, init)
+                for k, seed, init in tracked()]
+    if backend == "PROCESSES":
+        return Parallel(n_jobs=n_jobs)(
+            delayed(fit_clustering)(data, k, seed, runs, distances, method, sample_size, init)
+            for k, seed, init in tracked())
+    threads = max(1, cpu_count()//workers)
+    return Parallel(n_jobs=n_jobs, prefer="threads")(
+        delayed(fit_clustering_limited)(threads, data, k, seed, runs, distances, method, sample_size, init)
+        for k, seed, init in tracked())
+
+
+def golden_section_indices(n: int, score) -> None:
+    """
+    Golden-section search for the maximum of score(i) over i in [0, n),
+    assuming a single peak, then of every index left in the final bracket;
+    score is expected to cache its values
+    """
+    inv_phi = (np.sqrt(5) - 1) / 2
+    lo, hi = 0, n - 1
+    while hi - lo > 2:
+        a = lo + int(round((hi - lo)*(1 - inv_phi)))
+        b = max(lo + int(round((hi - lo)*inv_phi)), a + 1)
+        # ties move towards the larger K, as in extract_best_k
+        if score(a) > score(b):
+            hi = b - 1
+        else:
+            lo = a
+    for i in range(lo, hi + 1):
+        score(i)
+
+
+def k_values(krange: list, n_samples: int) -> range:
+    """
+    Values of K searched for n_samples samples: the KMEANS range, up to
+    half the samples (empty when the pool is too small for the range)
+    """
+    # maxk = min(math.sqrt(len(data))+1, krange[1])+1
+    maxk = min(n_samples/2, krange[1])+1
+    # perform K-Means for all possible values of K
+    # for k in range(3, min(math.ceil(len(data)/2), maxsamples)):
+    if maxk > n_samples:
+        maxk = n_samples
+    return range(int(krange[0]), int(maxk), int(krange[2]))
 
 
 # Implemented by Felipe V. Calderan
 def perform_clustering_n_random(krange: list, 
                                 seed_list: int,
                                 runs: int, 
-                                data: npt.NDArray[float]):
+                                data: npt.NDArray[float],
+                                n_jobs: int = 1,
+                                backend: str = "THREADS",
+                                method: str = "EXACT",
+                                sample_size: int = SILHOUETTE_SAMPLE,
+                                search: str = "GRID",
+                                patience: int = PATIENCE):
     """
-    Perform K-Means clustering n_random times for all possible values of K
+    Perform K-Means clustering n_random times for the values of K
+    n_jobs  - workers sharing the (k, seed) fits; the results do not depend
+              on the scheduling
+    backend - "THREADS" shares data and distances in memory, with the native
+              (OpenMP/BLAS) pools of each fit limited to cpus/n_jobs threads;
+              "PROCESSES" uses joblib workers, which memory-map the large arrays
+              and limit their inner threads the same way
+    method, sample_size - silhouette estimate, see fit_clustering
+    search  - "GRID" fits every K; "SWEEP" goes up the Ks, adding to the
+              random runs of each seed one started from its previous solution
+              with the worst cluster split (split_worst_cluster), and stops
+              once `patience` Ks in a row score below the best mean; "GOLDEN" evaluates only the Ks of
+              a golden-section search on the mean score
+    Returns the Cluster of each K evaluated (scores of all seeds, labels and
+    centroids of the best one) and these Ks, in increasing order
     """
 
-    # this stores clustering data of all seeds for all ks
-    all_clusterings = []
+    set_k = k_values(krange, len(data))
+    exact = method == "EXACT" or (method == "SAMPLED" and sample_size >= len(data))
+    distances = DistanceCache(data) if exact else None # shared by every (k, seed)
+
+    progress = tqdm.tqdm(total=len(set_k)*len(seed_list), desc='Searching K', leave=False, position=1)
+    # fits are folded into one Cluster per K as they complete, in batches,
+    # so that only the best labelling of each K is kept
+    batch = max(len(seed_list), 4*effective_n_jobs(n_jobs))
+    evaluated = {}
+
+    def fit(tasks: list) -> list:
+        """
+        Fit a list of (index of K, index of seed, init); returns the centroids
+        """
+        centroids = []
+        for start in range(0, len(tasks), batch):
+            part = tasks[start:start+batch]
+            results = fit_batch([(set_k[i], seed_list[j], init) for i, j, init in part],
+                                data, runs, distances, method, sample_size, n_jobs, backend, progress)
+            for (i, j, _), (labels, centers, score, wcss) in zip(part, results):
+                if i not in evaluated:
+                    evaluated[i] = Cluster(len(seed_list))
+                    evaluated[i].best_k = set_k[i]
+                evaluated[i].insert(j, labels, centers, score, wcss)
+                centroids.append(centers)
+        return centroids
+
+    seeds = range(len(seed_list))
+    mean = lambda i: np.mean(evaluated[i].scores)
+    if search == "GRID":
+        fit([(i, j, None) for i in range(len(set_k)) for j in seeds])
+    elif search == "SWEEP":
+        best = float("-inf")
+        declines = 0
+        for i, k in enumerate(set_k):
+            if i == 0:
+                previous = fit([(i, j, None) for j in seeds])
+            else:
+                previous = fit([(i, j, split_worst_cluster(data, previous[j], seed_list[j], k - set_k[i-1]))
+                                for j in seeds])
+            if mean(i) >= best:
+                best = mean(i)
+                declines = 0
+            else:
+                declines += 1
+                if declines >= patience:
+                    break
+    else:
+        def score(i):
+            if i not in evaluated:
+                fit([(i, j, None) for j in seeds])
+            return mean(i)
+        if len(set_k) > 0:
+            golden_section_indices(len(set_k), score)
+    progress.close()
+
+    order = sorted(evaluated)
+    if search != "GRID":
+        print(f"\t\t\tK search ({search}): {len(order)} of {len(set_k)} values of K fitted")
+    return [evaluated[i] for i in order], [set_k[i] for i in order]
 
-    # maxk = min(math.sqrt(len(data))+1, krange[1])+1
-    maxk = min(len(data)/2, krange[1])+1
-    # perform K-Means for all possible values of K
-    # for k in range(3, min(math.ceil(len(data)/2), maxsamples)):
-    if maxk > len(data):
-        maxk = len(data)
-    set_k = range(int(krange[0]), int(maxk), int(krange[2]))
-    for k in tqdm.tqdm(set_k, desc='Searching K', leave=False, position=1):
-        # print("K: ", k, len(seed_list))
-        # this stores clustering data for result values of all available seeds
-        clustering = []
-
-        # perform K-Means for all available seeds
-        for i, seed in enumerate(seed_list):
-            kmeans = KMeans(n_clusters=k, n_init=runs, random_state=seed).fit(data)
-            score = calculate_silhouette(data, kmeans.labels_, k)
-            # print(k, i, score)
-            wcss = kmeans.inertia_
-
-            c = Cluster(1)
-            c.best_k = k
-            c.insert(k, kmeans.labels_, kmeans.cluster_centers_, score, wcss)
-            # print("K: ", k, c.labels[0])#kmeans.labels_)
-            clustering.append(c)
-            # print("Cluster: ",k,i," - ", c, "\n\n")
-            
-
-        all_clusterings.append(clustering)
-    return all_clusterings, set_k
 
 # Implemented by Felipe V. Calderan
 def extract_best_k(krange: list, 
@@ -90,9 +377,7 @@ def extract_best_k(krange: list,
 
     # compute means and variances
     for i, clus in enumerate(clusters_data):
-        scores = []
-        for d in clus:
-            scores.append(d.scores[0])
+        scores = clus.scores
         k_scores.append(
             {"k": set_k[i], "mean": np.mean(scores), "var": np.var(scores)}
         )
@@ -125,35 +410,35 @@ def extract_best_k(krange: list,
     return best_k, best_mean, k_scores
 
 
+def report_k_scores(method: str, k_scores: list, best_k: int) -> None:
+    """
+    Print the silhouette estimate of every K with its variance across the
+    seeds, to judge whether an approximate method separates the Ks
+    """
+    print(f"\t\t\tSilhouette ({method}) per K, mean (variance) over seeds:")
+    for s in k_scores:
+        marker = " <-" if s["k"] == best_k else ""
+        print(f"\t\t\t  K = {s['k']}: {s['mean']:.4f} ({s['var']:.2e}){marker}")
+
+
 # Implemented by Felipe V. Calderan
 def pick_best_candidate(krange: list,
-                        clusters_data: list[list[Cluster]], 
+                        clusters_data: list[Cluster], 
                         best_k: int) -> Cluster:
     """
-    Pick the best candidate from the clusterings that have the best K
+    Pick the best candidate from the clusterings that have the best K:
+    the Cluster of that K, which holds its best seed
     """
 
-    start_k = krange[0]
-
-
-    Ks = [clus[0].best_k for clus in clusters_data]
-    for id, clus in enumerate(clusters_data):
-        if clus[0].best_k == best_k:
-            idc = id
-            best_cluster_data = clus
-            break
-
-    best_score = float("-inf")
-    best_i = -1
-
-    for i, bcd in enumerate(best_cluster_data):
-        if bcd.scores[0] > best_score:
-            best_score = bcd.scores[0]
-            best_i = i
-
-    return best_cluster_data[best_i]
+    for clus in clusters_data:
+        if clus.best_k == best_k:
+            return clus
 
-def get_representatives(params : dict, coulomb, energies, pfiles: str):
+def get_representatives(params : dict, coulomb, energies, pfiles: str, rng=np.random):
+    """
+    rng - source of the K search seeds and of the extra samples drawn per
+          cluster (a np.random.RandomState; the global np.random state by default)
+    """
     runs = params["RUN_KMEANS"]
     cluster_labels = []
     cluster_centroids = []            
@@ -173,8 +458,14 @@ def get_representatives(params : dict, coulomb, energies, pfiles: str):
     else: 
         # Optimize K with Silhouette
         # print("\t\tSilhouette: k searching")
-        pseudo_seeds = [np.random.randint(999999) for i in range(10)]
-        evaluation, set_k = perform_clustering_n_random(params["KMEANS"], pseudo_seeds, runs, coulomb)
+        pseudo_seeds = [rng.randint(999999) for i in range(10)]
+        evaluation, set_k = perform_clustering_n_random(params["KMEANS"], pseudo_seeds, runs, coulomb,
+                                                        params.get("KMEANS_JOBS", 1),
+                                                        params.get("KMEANS_BACKEND", "THREADS"),
+                                                        params.get("SILHOUETTE", "EXACT"),
+                                                        params.get("SILHOUETTE_SAMPLE", SILHOUETTE_SAMPLE),
+                                                        params.get("K_SEARCH", "GRID"),
+                                                        params.get("PATIENCE", PATIENCE))
         if len(evaluation)==0:
             print("\n\n\t\t\tFail - there is not enough samples to perform data clustering")
             try:
@@ -185,11 +476,13 @@ def get_representatives(params : dict, coulomb, energies, pfiles: str):
             exit()
 
         best_k, best_mean, k_scores = extract_best_k(params["KMEANS"], evaluation, set_k)
+        if params.get("SILHOUETTE", "EXACT") != "EXACT":
+            report_k_scores(params["SILHOUETTE"], k_scores, best_k)
         # print("Bestk: ", evaluation)
         result = pick_best_candidate(params["KMEANS"], evaluation, best_k)
         # print("\t\tResult from clustering analysis: K = ",best_k)
-        cluster_labels = result.labels[0] 
-        cluster_centroids = result.centroids[0]
+        cluster_labels = result.labels
+        cluster_centroids = result.centroids
 
     sel_samples = []
     n_samples = params["MAXSAMPLES"]-1
@@ -205,7 +498,7 @@ def get_representatives(params : dict, coulomb, energies, pfiles: str):
         ids = ids[ids != closest_id]
         if n_samples > 0:
             if n_samples < len(cluster_points)-1:
-                samples = ids[np.random.choice(ids.shape[0], 
+                samples = ids[rng.choice(ids.shape[0], 
                                                           n_samples, 
                                                           replace=False)]
             else:
@@ -215,3 +508,138 @@ def get_representatives(params : dict, coulomb, energies, pfiles: str):
 
     return sel_samples
 
+def deduplicate(descriptors: npt.NDArray[float], tol: float, energies=None) -> npt.NDArray[int]:
+    """
+    Near-duplicate elimination on the (scaled) descriptors: by increasing
+    energy (structures without energy last, then input order), each
+    structure not merged yet is kept and claims the unclaimed ones within
+    `tol` of it (cKDTree ball query), so m copies cost one query and the
+    kept structure is the lowest-energy member of its group
+    Returns owner: owner[i] is the structure i was merged into (i if kept)
+    """
+    if energies is None:
+        order = range(len(descriptors))
+    else:
+        keys = np.array([np.inf if e is None else e for e in energies], dtype=float)
+        order = np.lexsort((np.arange(len(keys)), keys))
+    tree = cKDTree(descriptors)
+    owner = np.full(len(descriptors), -1)
+    for i in order:
+        if owner[i] >= 0:
+            continue
+        neighbors = np.asarray(tree.query_ball_point(descriptors[i], tol), dtype=int)
+        owner[neighbors[owner[neighbors] < 0]] = i
+    return owner
+
+
+def get_unique_representatives(params: dict, coulomb, energies, pfiles, record: str = None) -> list:
+    """
+    get_representatives over the pool without near-duplicates when DEDUP_TOL
+    is set (see deduplicate); the merged structures are written to `record`
+    as CSV lines "structure,kept". Returns indices into the full pool; all
+    the kept structures when too few are left for the KMEANS range
+    """
+    tol = params.get("DEDUP_TOL")
+    if tol is None:
+        return get_representatives(params, coulomb, energies, pfiles)
+
+    owner = deduplicate(coulomb, tol, energies)
+    kept = np.flatnonzero(owner == np.arange(len(owner)))
+    print(f"\t\t\tDuplicates: {len(owner)-len(kept)} of {len(owner)} structures merged "
+          f"(tolerance {tol}), {len(kept)} left")
+    if record is not None:
+        with open(record, "w") as out:
+            out.write("structure,kept\n")
+            for i in np.flatnonzero(owner != np.arange(len(owner))):
+                out.write(f"{pfiles[i]},{pfiles[owner[i]]}\n")
+
+    if len(kept) == 1 or (len(params["KMEANS"]) > 1 and len(k_values(params["KMEANS"], len(kept))) == 0):
+        print("\t\t\tToo few structures left for the K search: all of them are selected")
+        return [int(i) for i in kept]
+    sel_samples = get_representatives(params, coulomb[kept], [energies[i] for i in kept],
+                                      [pfiles[i] for i in kept])
+    return [int(kept[i]) for i in sel_samples]
+
+
+def get_representatives_stream(params: dict, descriptors: npt.NDArray[float],
+                               chunk: int = STREAM_CHUNK) -> list:
+    """
+    get_representatives for pools too large for memory: `descriptors` is
+    read in chunks (e.g. a memory-mapped array), the scaler and a
+    MiniBatchKMeans are fitted incrementally, and a second pass keeps, per
+    cluster, the sample closest to the centroid and a uniform random
+    subset of MAXSAMPLES-1 other members (random keys, smallest kept).
+    K (with a KMEANS range) and the initial centroids come from a random
+    subsample of at most STREAM_SEARCH_SAMPLE samples
+    """
+    n = len(descriptors)
+    starts = range(0, n, chunk)
+    scaler = StandardScaler()
+    for start in starts:
+        scaler.partial_fit(descriptors[start:start+chunk])
+
+    sample = np.sort(np.random.choice(n, min(n, STREAM_SEARCH_SAMPLE), replace=False))
+    data = scaler.transform(descriptors[sample])
+    if len(params["KMEANS"])==1:
+        k = min(params["KMEANS"][0], n)
+    else:
+        pseudo_seeds = [np.random.randint(999999) for i in range(10)]
+        evaluation, set_k = perform_clustering_n_random(params["KMEANS"], pseudo_seeds, params["RUN_KMEANS"], data,
+                                                        params.get("KMEANS_JOBS", 1),
+                                                        params.get("KMEANS_BACKEND", "THREADS"),
+                                                        params.get("SILHOUETTE", "EXACT"),
+                                                        params.get("SILHOUETTE_SAMPLE", SILHOUETTE_SAMPLE),
+                                                        params.get("K_SEARCH", "GRID"),
+                                                        params.get("PATIENCE", PATIENCE))
+        if len(evaluation)==0:
+            print("\n\n\t\t\tFail - there is not enough samples to perform data clustering")
+            exit()
+        k, best_mean, k_scores = extract_best_k(params["KMEANS"], evaluation, set_k)
+        if params.get("SILHOUETTE", "EXACT") != "EXACT":
+            report_k_scores(params["SILHOUETTE"], k_scores, k)
+    print(f"\t\t\tMini-batch k-means: K = {k} over {n} samples")
+
+    # centroids seeded by a full k-means on the subsample, refined over all the chunks
+    init = KMeans(n_clusters=k, n_init=params["RUN_KMEANS"], random_state=0).fit(data).cluster_centers_
+    kmeans = MiniBatchKMeans(n_clusters=k, init=init, n_init=1, random_state=0, batch_size=min(chunk, n))
+    rng = np.random.default_rng(0)
+    for step in range(STREAM_EPOCHS*len(starts)):
+        # random rows rather than consecutive chunks: the pools are ordered by source
+        batch = np.sort(rng.choice(n, min(chunk, n), replace=False))
+        kmeans.partial_fit(scaler.transform(descriptors[batch]))
+
+    # second pass: closest sample and random members of each cluster
+    n_samples = params["MAXSAMPLES"]-1
+    closest = np.full(k, -1)
+    closest_dist = np.full(k, np.inf)
+    kept_ids = np.zeros(0, dtype=np.int64)
+    kept_labels = np.zeros(0, dtype=np.int64)
+    kept_keys = np.zeros(0)
+    for start in starts:
+        x = scaler.transform(descriptors[start:start+chunk])
+        labels = kmeans.predict(x)
+        dist = np.linalg.norm(x - kmeans.cluster_centers_[labels], axis=1)
+        order = np.lexsort((dist, labels))
+        first = order[np.unique(labels[order], return_index=True)[1]]
+        better = dist[first] < closest_dist[labels[first]]
+        closest[labels[first][better]] = start + first[better]
+        closest_dist[labels[first][better]] = dist[first][better]
+        if n_samples > 0:
+            kept_ids = np.concatenate((kept_ids, start + np.arange(len(x))))
+            kept_labels = np.concatenate((kept_labels, labels))
+            kept_keys = np.concatenate((kept_keys, rng.random(len(x))))
+            order = np.lexsort((kept_keys, kept_labels))
+            rank = np.arange(len(order)) - np.searchsorted(kept_labels[order], kept_labels[order])
+            keep = order[rank <= n_samples] # n_samples+1 per cluster, the closest may be among them
+            kept_ids, kept_labels, kept_keys = kept_ids[keep], kept_labels[keep], kept_keys[keep]
+
+    sel_samples = []
+    for cluster in range(k):
+        if closest[cluster] < 0: # empty cluster
+            continue
+        sel_samples.append(int(closest[cluster]))
+        if n_samples > 0:
+            members = kept_ids[kept_labels == cluster]
+            members = members[members != closest[cluster]][:n_samples]
+            sel_samples.extend(int(idx) for idx in members)
+    return sel_samples
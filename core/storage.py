@@ -0,0 +1,424 @@
+from __future__ import annotations
+import os
+import glob
+import gzip
+import shutil
+import mmap
+import numpy as np
+import numpy.typing as npt
+
+import core.tools as tools
+import core.elements as elements
+
+
+class XYZArchive:
+    """
+    Multi-frame XYZ archive holding all the structures of a workflow stage
+
+    Frames are buffered in memory and flushed in bulk into a few part files
+    (<folder>/archive_<part>.xyz, or .xyz.gz blocks when compressed) while
+    <folder>/archive.idx records where each structure lives, so any of them
+    can be read back without scanning the parts
+    """
+
+    INDEX = "archive.idx"
+
+    def __init__(self, folder: str, compress: bool = False,
+                 frames_per_file: int = 50000, buffer_frames: int = 2000):
+        self.folder = folder
+        self.compress = compress
+        self.frames_per_file = frames_per_file
+        self.buffer_frames = buffer_frames
+        self.buffer = []
+        self.index = {}
+        self.order = []
+        self.part_count = {}
+        os.makedirs(folder, exist_ok=True)
+        if os.path.exists(self.index_file()):
+            with open(self.index_file()) as f:
+                for line in f:
+                    name, part, *offsets = line.rstrip("\n").split("\t")
+                    if name not in self.index:
+                        self.order.append(name)
+                    self.index[name] = (part, *map(int, offsets)) # a rewritten name keeps its last frame
+                    self.part_count[part] = self.part_count.get(part, 0) + 1
+            if self.order:
+                self.compress = self.index[self.order[-1]][0].endswith(".gz")
+
+    def index_file(self) -> str:
+        return os.path.join(self.folder, self.INDEX)
+
+    def part_name(self, part: int) -> str:
+        return f"archive_{part:04d}.xyz" + (".gz" if self.compress else "")
+
+    def __len__(self) -> int:
+        self.flush()
+        return len(self.order)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def names(self) -> list:
+        self.flush()
+        return list(self.order)
+
+    def write(self, list_atoms, list_coords, energy, pfile: str, **provenance) -> None:
+        """
+        Append a structure, same arguments as tools.generateXYZ (provenance is not kept)
+        """
+        frame = tools.formatXYZ(list_atoms, list_coords, energy)
+        self.write_raw(pfile, frame.encode())
+
+    def write_raw(self, pfile: str, frame: bytes) -> None:
+        """
+        Append an already formatted XYZ frame; writing a name again replaces
+        its structure, as rewriting a file of the per-file layout
+        """
+        if not frame.endswith(b"\n"):
+            frame += b"\n"
+        self.buffer.append((os.path.basename(pfile), frame))
+        if len(self.buffer) >= self.buffer_frames:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write the buffered frames to the part files and the index
+        """
+        entries = []
+        while self.buffer:
+            part = len(self.part_count) - 1
+            if part < 0 or self.part_count[self.part_name(part)] >= self.frames_per_file:
+                part += 1
+            part = self.part_name(part)
+            room = self.frames_per_file - self.part_count.get(part, 0)
+            frames, self.buffer = self.buffer[:room], self.buffer[room:]
+
+            fname = os.path.join(self.folder, part)
+            offset = os.path.getsize(fname) if os.path.exists(fname) else 0
+            block = b"".join(frame for _, frame in frames)
+            if self.compress:
+                data = gzip.compress(block)
+            else:
+                data = block
+            with open(fname, "ab") as f:
+                f.write(data)
+
+            inner = 0
+            for name, frame in frames:
+                if self.compress:
+                    entry = (part, offset, len(data), inner, len(frame))
+                else:
+                    entry = (part, offset+inner, len(frame), 0, len(frame))
+                entries.append((name, entry))
+                inner += len(frame)
+            self.part_count[part] = self.part_count.get(part, 0) + len(frames)
+
+        if entries:
+            with open(self.index_file(), "a") as f:
+                for name, entry in entries:
+                    if name not in self.index:
+                        self.order.append(name)
+                    self.index[name] = entry
+                    f.write("\t".join(map(str, (name, *entry))) + "\n")
+
+    def close(self) -> None:
+        self.flush()
+
+    def read(self, name: str) -> bytes:
+        """
+        Raw XYZ text of a single structure (random access through the index)
+        """
+        self.flush()
+        part, offset, length, inner, size = self.index[name]
+        with open(os.path.join(self.folder, part), "rb") as f:
+            f.seek(offset)
+            data = f.read(length)
+        if part.endswith(".gz"):
+            data = gzip.decompress(data)
+        return data[inner:inner+size]
+
+    def get(self, name: str) -> tuple:
+        """
+        Parsed structure: (name, codes, coords, energy), as tools.readFrames
+        """
+        return (name, *parseRaw(self.read(name)))
+
+    def items(self):
+        """
+        Stream (name, raw XYZ text) for every structure, in insertion order
+        """
+        self.flush()
+        block_key = None
+        buffer = None
+        handles = {}
+        try:
+            for name in self.order:
+                part, offset, length, inner, size = self.index[name]
+                if part not in handles:
+                    for handle in handles.values():
+                        handle.close()
+                    f = open(os.path.join(self.folder, part), "rb")
+                    handles = {part: mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)}
+                    f.close()
+                if (part, offset) != block_key:
+                    block_key = (part, offset)
+                    buffer = handles[part][offset:offset+length]
+                    if part.endswith(".gz"):
+                        buffer = gzip.decompress(buffer)
+                yield name, buffer[inner:inner+size]
+        finally:
+            for handle in handles.values():
+                handle.close()
+
+    def frames(self):
+        """
+        Stream (name, codes, coords, energy) for every structure, as tools.readFrames
+        """
+        for name, raw in self.items():
+            yield (name, *parseRaw(raw))
+
+    def import_file(self, fname: str, name: str) -> None:
+        with open(fname, "rb") as f:
+            self.write_raw(name, f.read())
+
+    def energies(self) -> list:
+        return [energy for _, _, _, energy in self.frames()]
+
+    def descriptors(self) -> npt.NDArray[float]:
+        coulomb, _ = tools.eigenCoulombFrames(self.frames())
+        return coulomb
+
+    def subset(self, indices, folder: str) -> XYZArchive:
+        """
+        Copy the structures at `indices` to a new archive in `folder`
+        """
+        wanted = set(int(idx) for idx in indices)
+        raw_frames = {idx: item for idx, item in enumerate(self.items()) if idx in wanted}
+        with XYZArchive(folder, compress=self.compress) as target:
+            for idx in indices:
+                target.write_raw(*raw_frames[int(idx)])
+        return target
+
+    def copy_to(self, folder: str) -> None:
+        """
+        Copy the part files and the index to another folder
+        """
+        self.flush()
+        os.makedirs(folder, exist_ok=True)
+        for fname in glob.glob(f"{self.folder}/archive_*.xyz*") + [self.index_file()]:
+            shutil.copy(fname, folder)
+
+    def export(self, folder: str, names=None) -> None:
+        """
+        Write the structures (all, or the given names) as one XYZ file each
+        """
+        names = self.names() if names is None else names
+        for name in names:
+            with open(os.path.join(folder, name+".xyz"), "wb") as f:
+                f.write(self.read(name))
+
+
+class StructureStore:
+    """
+    Columnar container for all the structures of a workflow stage
+
+    Species codes and coordinates of every structure are kept as flat arrays
+    (split by `offsets`) next to per-structure energies, provenance (source
+    frame, permutation and sample indices, -1 when not applicable) and,
+    once computed, the Coulomb eigenvalue descriptors. The stage is saved as
+    a single <folder>/store.npz and loaded back without any text parsing
+    """
+
+    FILE = "store.npz"
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.names_ = []
+        self.codes = []
+        self.coords = []
+        self.energies_ = []
+        self.source = []
+        self.permutation = []
+        self.sample = []
+        self.descriptors_ = None
+        os.makedirs(folder, exist_ok=True)
+        if os.path.exists(self.file()):
+            with np.load(self.file()) as data:
+                offsets = data["offsets"]
+                self.names_ = list(data["names"])
+                self.codes = np.split(data["codes"], offsets[1:-1])
+                self.coords = np.split(data["coords"], offsets[1:-1])
+                self.energies_ = list(data["energies"])
+                self.source = list(data["source"])
+                self.permutation = list(data["permutation"])
+                self.sample = list(data["sample"])
+                if "descriptors" in data:
+                    self.descriptors_ = data["descriptors"]
+
+    def file(self) -> str:
+        return os.path.join(self.folder, self.FILE)
+
+    def __len__(self) -> int:
+        return len(self.names_)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def names(self) -> list:
+        return list(self.names_)
+
+    def append(self, name: str, codes, coords, energy,
+               source: str = "", permutation: int = -1, sample: int = -1) -> None:
+        self.names_.append(os.path.basename(name))
+        self.codes.append(np.asarray(codes, dtype=np.int16))
+        self.coords.append(np.asarray(coords, dtype="float64"))
+        self.energies_.append(np.nan if energy is None else energy)
+        self.source.append(source)
+        self.permutation.append(permutation)
+        self.sample.append(sample)
+        self.descriptors_ = None
+
+    def write(self, list_atoms, list_coords, energy, pfile: str, **provenance) -> None:
+        """
+        Append a structure, same arguments as tools.generateXYZ
+        """
+        self.append(pfile, elements.encode(list_atoms), list_coords, energy, **provenance)
+
+    def import_file(self, fname: str, name: str) -> None:
+        for _, codes, coords, energy in tools.readFrames(fname):
+            self.append(name, codes, coords, energy)
+
+    def close(self) -> None:
+        """
+        Save the stage to <folder>/store.npz
+        """
+        lengths = [len(codes) for codes in self.codes]
+        data = dict(
+            names=np.array(self.names_, dtype=str),
+            offsets=np.concatenate(([0], np.cumsum(lengths))).astype(np.int64),
+            codes=np.concatenate(self.codes) if self.codes else np.zeros(0, dtype=np.int16),
+            coords=np.concatenate(self.coords) if self.coords else np.zeros((0, 3)),
+            energies=np.array(self.energies_, dtype="float64"),
+            source=np.array(self.source, dtype=str),
+            permutation=np.array(self.permutation, dtype=np.int32),
+            sample=np.array(self.sample, dtype=np.int32),
+        )
+        if self.descriptors_ is not None:
+            data["descriptors"] = self.descriptors_
+        np.savez(self.file(), **data)
+
+    def frames(self):
+        """
+        Stream (name, codes, coords, energy) for every structure, as tools.readFrames
+        """
+        for name, codes, coords, energy in zip(self.names_, self.codes, self.coords, self.energies_):
+            yield name, codes, coords, (None if np.isnan(energy) else energy)
+
+    def energies(self) -> list:
+        return [None if np.isnan(energy) else energy for energy in self.energies_]
+
+    def descriptors(self) -> npt.NDArray[float]:
+        """
+        Coulomb eigenvalues of every structure, computed once and cached in
+        memory; they are saved with the store only when its owner closes it
+        (reading a stage does not rewrite its store.npz)
+        """
+        if self.descriptors_ is None:
+            charges = [elements.NUMBERS[codes] for codes in self.codes]
+            self.descriptors_ = tools.eigenCoulombBatch(np.array(self.coords), np.array(charges))
+        return self.descriptors_
+
+    def subset(self, indices, folder: str) -> StructureStore:
+        """
+        Copy the structures at `indices` to a new store in `folder`
+        """
+        target = StructureStore(folder)
+        for idx in indices:
+            target.append(self.names_[idx], self.codes[idx], self.coords[idx], self.energies_[idx],
+                          self.source[idx], self.permutation[idx], self.sample[idx])
+        if self.descriptors_ is not None:
+            target.descriptors_ = self.descriptors_[np.asarray(indices, dtype=int)]
+        target.close()
+        return target
+
+    def copy_to(self, folder: str) -> None:
+        """
+        Copy store.npz to another folder and export its structures as XYZ files there
+        """
+        os.makedirs(folder, exist_ok=True)
+        shutil.copy(self.file(), folder)
+        self.export(folder)
+
+    def export(self, folder: str, names=None) -> None:
+        """
+        Write the structures (all, or the given names) as one XYZ file each
+        """
+        selected = None if names is None else set(names)
+        for name, codes, coords, energy in self.frames():
+            if selected is None or name in selected:
+                with open(os.path.join(folder, name+".xyz"), "w") as f:
+                    f.write(tools.formatXYZ(elements.decode(codes), coords, energy))
+
+
+def parseRaw(raw: bytes) -> tuple:
+    return next(tools.parseBuffer(raw))
+
+def is_archive(folder: str) -> bool:
+    return os.path.exists(os.path.join(folder, XYZArchive.INDEX))
+
+def is_store(folder: str) -> bool:
+    return os.path.exists(os.path.join(folder, StructureStore.FILE))
+
+def open_source(folder: str):
+    """
+    Archive or store saved in a stage folder, None for the per-file layout
+    """
+    if is_store(folder):
+        return StructureStore(folder)
+    if is_archive(folder):
+        return XYZArchive(folder)
+    return None
+
+def open_stage(folder: str, fmt: str = "XYZ"):
+    """
+    Output target of a stage: the folder itself for the per-file layout
+    (default), a multi-frame archive ("ARCHIVE", "ARCHIVE_GZ") or a
+    columnar store ("STORE"). All are accepted by tools.generateXYZ
+    """
+    if fmt == "XYZ":
+        return folder if folder.endswith("/") else folder+"/"
+    if fmt in ("ARCHIVE", "ARCHIVE_GZ"):
+        return XYZArchive(folder, compress=(fmt == "ARCHIVE_GZ"))
+    if fmt == "STORE":
+        return StructureStore(folder)
+    raise ValueError(f"unknown OUTPUT_FORMAT: {fmt}")
+
+def stage_frames(folder: str):
+    """
+    Stream (name, codes, coords, energy) from a stage folder, whatever its layout
+    """
+    source = open_source(folder)
+    if source is not None:
+        return source.frames()
+    return tools.readFrames(folder)
+
+def stage_count(folder: str) -> int:
+    if is_store(folder):
+        with np.load(os.path.join(folder, StructureStore.FILE)) as data:
+            return len(data["names"])
+    if is_archive(folder):
+        return len(XYZArchive(folder))
+    return len(glob.glob(f"{folder}/*.xyz"))
+
+def close_stage(target) -> None:
+    """
+    Flush an output target returned by open_stage
+    """
+    if not isinstance(target, str):
+        target.close()
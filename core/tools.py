@@ -7,19 +7,61 @@ import glob
 import math
 import ast
 import os
+import mmap
+import itertools
+from joblib import Parallel, effective_n_jobs
+
+import core.elements as elements
+
+# largest number of items (structures, frames) in one parallel task
+PARALLEL_CHUNK = 256
+
+# size of the Coulomb matrices (structures x atoms^2 float64) built at once;
+# larger stacks are diagonalized in chunks, so that the peak memory (a few
+# arrays of this size) does not depend on the number or size of the structures
+COULOMB_BATCH_BYTES = 32 << 20
+
+def coulomb_chunk(natoms: int) -> int:
+    """
+    Number of natoms-atom Coulomb matrices that fit COULOMB_BATCH_BYTES
+    """
+    return max(1, COULOMB_BATCH_BYTES // (8*max(1, natoms)**2))
+
+def parallel_waves(n_jobs: int, tasks, stop=None):
+    """
+    Run joblib delayed tasks and yield their results in order. Without
+    `stop`, all the tasks go to a single Parallel call; with it, they are
+    dispatched one wave (one task per worker) at a time and no wave is
+    dispatched once stop() is true, so the work done and the results held
+    past a streaming target are bounded by one wave
+    """
+    if stop is None:
+        yield from Parallel(n_jobs=n_jobs)(tasks)
+        return
+    workers = effective_n_jobs(n_jobs)
+    tasks = iter(tasks)
+    with Parallel(n_jobs=n_jobs) as parallel:
+        while not stop():
+            wave = list(itertools.islice(tasks, workers))
+            if not wave:
+                break
+            yield from parallel(wave)
+
+def target_reached(target):
+    """
+    stop() of parallel_waves for an output: the `done` flag of a streaming
+    filter with a target count, None for any other output
+    """
+    if getattr(target, "limit", None) is None:
+        return None
+    return lambda: target.done
 
 def xyzRead(fname: str):
     fin = open(fname, "r")
     line1 = fin.readline().split()
     natoms = int(line1[0])
     comments = fin.readline()[:-1]
-    if comments: 
-        try:
-            energy = int(comments.split()[-1])
-        except:
-            energy = None
-    else:
-        energy = None
+    energy = parseEnergy(comments)
     coords = np.zeros([natoms, 3], dtype="float64")
     atomtypes = []
     for x in coords:
@@ -28,6 +70,128 @@ def xyzRead(fname: str):
         x[:] = list(map(float, line[1:4]))
     return natoms, atomtypes, coords, energy
 
+def parseEnergy(comments: str):
+    if comments: 
+        try:
+            energy = int(comments.split()[-1])
+        except:
+            energy = None
+    else:
+        energy = None
+    return energy
+
+# files up to this size are read and parsed whole; larger ones are
+# memory-mapped and parsed in blocks of about this many bytes of frames
+READ_BLOCK_BYTES = 16 << 20
+
+# species label (bytes, as read) -> integer code, filled as labels are met
+SYMBOL_CODES = {}
+
+def symbolCode(symbol: bytes) -> int:
+    code = SYMBOL_CODES.get(symbol)
+    if code is None:
+        code = SYMBOL_CODES[symbol] = elements.CODES[symbol.decode()]
+    return code
+
+def parseBuffer(data: bytes):
+    """
+    Parse all the XYZ frames of a bytes buffer at once: the buffer is split
+    once, and the species and positions of every frame are converted
+    together from the tokens of all the atom lines
+    Yield (codes, coords, energy) for each frame
+    """
+    lines = data.split(b"\n")
+    headers = []
+    atom_lines = []
+    index = 0
+    while index < len(lines):
+        if not lines[index].strip(): # blank separator line
+            index += 1
+            continue
+        natoms = int(lines[index])
+        headers.append((natoms, lines[index+1].decode().rstrip("\r")))
+        atom_lines.extend(lines[index+2:index+2+natoms])
+        index += natoms+2
+    if not headers:
+        return
+
+    tokens = b" ".join(atom_lines).split()
+    if len(tokens) != 4*len(atom_lines): # extra columns, only the species and positions are kept
+        tokens = [token for line in atom_lines for token in line.split()[:4]]
+    symbols = tokens[0::4]
+    try:
+        codes = np.array([SYMBOL_CODES[symbol] for symbol in symbols], dtype=np.int16)
+    except KeyError: # first frame with a new species
+        codes = np.array([symbolCode(symbol) for symbol in symbols], dtype=np.int16)
+    del tokens[0::4]
+    coords = np.array(tokens, dtype="float64").reshape(-1, 3)
+
+    start = 0
+    for natoms, comments in headers:
+        yield codes[start:start+natoms], coords[start:start+natoms], parseEnergy(comments)
+        start += natoms
+
+def parseFrames(buffer, block: int = READ_BLOCK_BYTES):
+    """
+    Parse the XYZ frames of a file-like buffer (e.g. a memory-mapped file), in a single pass
+    The frames are gathered in blocks of about `block` bytes, each parsed by parseBuffer
+    Yield (codes, coords, energy) for each frame
+    """
+    frames = []
+    size = 0
+    line = buffer.readline()
+    while line:
+        if line.strip(): # not a blank separator line
+            frame = [line] + [buffer.readline() for _ in range(int(line)+1)]
+            frames.extend(frame)
+            size += sum(map(len, frame))
+            if size >= block:
+                yield from parseBuffer(b"".join(frames))
+                frames, size = [], 0
+        line = buffer.readline()
+    if frames:
+        yield from parseBuffer(b"".join(frames))
+
+def parseMapped(fin):
+    """
+    parseFrames over an open file, memory-mapped until the frames are consumed
+    """
+    with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        yield from parseFrames(buffer)
+
+def readFrames(path: str):
+    """
+    Stream the structures of an XYZ file, a multi-frame XYZ file or a folder of XYZ files
+    Files up to READ_BLOCK_BYTES are read whole, larger ones memory-mapped
+    and parsed in blocks (see parseFrames)
+    Yield (name, codes, coords, energy); frames of multi-frame files are named <file>_<index>
+    """
+    if os.path.isdir(path):
+        files = sorted(glob.glob(f"{path}/*.xyz"))
+    else:
+        files = [path]
+
+    for file in files:
+        base_name = os.path.splitext(os.path.basename(file))[0]
+        with open(file, "rb") as fin:
+            size = os.fstat(fin.fileno()).st_size
+            if size == 0:
+                continue
+            if size <= READ_BLOCK_BYTES:
+                frames = parseBuffer(fin.read())
+            else:
+                frames = parseMapped(fin)
+            first = next(frames, None)
+            second = next(frames, None)
+            if second is None:
+                if first is not None:
+                    yield (base_name, *first)
+                continue
+            yield (f"{base_name}_0", *first)
+            yield (f"{base_name}_1", *second)
+            for index, frame in enumerate(frames, 2):
+                yield (f"{base_name}_{index}", *frame)
+
 def replaceAtomSymbols(params: dict, fname: str, permut: tuple):
     with open(fname, 'r') as file:
         line = file.readline()
@@ -47,57 +211,162 @@ def replaceAtomSymbols(params: dict, fname: str, permut: tuple):
 
 
 def getCharge(element):
-    f = open("mol.txt")
-    atomicnum = [line.split()[1] for line in f if line.split()[0] == element]
-    f.close()
-    return int(atomicnum[0])
+    return int(elements.NUMBERS[elements.CODES[element]])
 
 def coulombMatrix(natoms, atomtypes, coords):
-    i=0 ; j=0    
-    colM = np.zeros((natoms,natoms))
-    chargearray = np.zeros((natoms,1))
-    charge = [getCharge(symbol)  for symbol in atomtypes]
-    for i in range(0,natoms):
-        colM[i,i]=0.5*charge[i]**2.4   # Diagonal term described by Potential energy of isolated atom
-        for j in range(i+1,natoms):
-            dist= np.linalg.norm(coords[i,:] - coords[j,:])   
-            colM[j,i] = charge[i]*charge[j]/dist   #Pair-wise repulsion 
-            colM[i,j] = colM[j,i]
+    charge = elements.NUMBERS[elements.encode(atomtypes)]
+    return coulombMatrices(coords[np.newaxis], charge[np.newaxis])[0]
+
+def coulombMatrices(coords: npt.NDArray[float], charges: npt.NDArray[float]) -> npt.NDArray[float]:
+    """
+    Build the Coulomb matrices of a stack of structures at once
+    coords  - (N, natoms, 3) array of positions
+    charges - (N, natoms) array of atomic numbers, or (natoms,) when shared
+    The distances are summed one axis at a time, so that no (N, natoms,
+    natoms, 3) array is built
+    """
+    coords = np.asarray(coords, dtype="float64")
+    charges = np.broadcast_to(np.asarray(charges, dtype="float64"), coords.shape[:2])
+    diag = np.eye(coords.shape[1], dtype=bool)
+
+    dist = np.zeros(coords.shape[:2] + coords.shape[1:2])
+    diff = np.empty_like(dist)
+    for axis in np.moveaxis(coords, 2, 0):
+        np.subtract(axis[:, :, np.newaxis], axis[:, np.newaxis, :], out=diff)
+        diff *= diff
+        dist += diff
+    np.sqrt(dist, out=dist)
+    dist[:, diag] = 1.0
+    colM = np.multiply(charges[:, :, np.newaxis], charges[:, np.newaxis, :], out=diff)
+    colM /= dist   #Pair-wise repulsion
+    colM[:, diag] = 0.5*charges**2.4   # Diagonal term described by Potential energy of isolated atom
     return colM
- 
+
+def eigenCoulombBatch(coords: npt.NDArray[float], charges: npt.NDArray[float],
+                      chunk: int = None) -> npt.NDArray[float]:
+    """
+    Sorted (descending) Coulomb matrix eigenvalues for a stack of structures
+    The matrices are diagonalized in chunks of `chunk` structures to bound
+    memory (by default as many as fit COULOMB_BATCH_BYTES)
+    """
+    coords = np.asarray(coords, dtype="float64")
+    charges = np.broadcast_to(np.asarray(charges, dtype="float64"), coords.shape[:2])
+    chunk = chunk or coulomb_chunk(coords.shape[1])
+    eigValues = np.empty(coords.shape[:2])
+    for start in range(0, len(coords), chunk):
+        sCoulomb = coulombMatrices(coords[start:start+chunk], charges[start:start+chunk])
+        sCoulomb = np.trunc(sCoulomb, out=sCoulomb) # same integer truncation as eigenCoulomb
+        eigValues[start:start+chunk] = np.linalg.eigvalsh(sCoulomb)[:, ::-1]
+    return eigValues
+
+def eigenCoulombHomotops(coords: npt.NDArray[float], charges: npt.NDArray[float],
+                         chunk: int = None) -> npt.NDArray[float]:
+    """
+    eigenCoulombBatch for many charge assignments (homotops) of one frame
+    coords  - (natoms, 3) positions shared by all homotops
+    charges - (N, natoms) atomic numbers of each homotop
+    The distance matrix is computed once and every Coulomb matrix is the
+    charge outer product over it
+    """
+    coords = np.asarray(coords, dtype="float64")
+    charges = np.asarray(charges, dtype="float64")
+    chunk = chunk or coulomb_chunk(len(coords))
+    diag = np.eye(len(coords), dtype=bool)
+    diff = coords[:, np.newaxis, :] - coords[np.newaxis, :, :]
+    dist = np.sqrt(np.einsum("ijk,ijk->ij", diff, diff))
+    dist[diag] = 1.0
+
+    eigValues = np.empty(charges.shape)
+    for start in range(0, len(charges), chunk):
+        charge = charges[start:start+chunk]
+        sCoulomb = charge[:, :, np.newaxis]*charge[:, np.newaxis, :]
+        sCoulomb /= dist
+        sCoulomb[:, diag] = 0.5*charge**2.4
+        sCoulomb = np.trunc(sCoulomb, out=sCoulomb)
+        eigValues[start:start+chunk] = np.linalg.eigvalsh(sCoulomb)[:, ::-1]
+    return eigValues
+
 def eigenCoulomb(natoms, atomtypes, coords):
-    sCoulomb = coulombMatrix(natoms, atomtypes, coords)
-    sCoulomb = sCoulomb.astype(int)
-    eigValues = -np.sort(-np.linalg.eigvals(sCoulomb))
-    if np.any(np.iscomplex(eigValues)) == False:
-        return eigValues#[0:natoms]
-    else:
-        # print('\nWARNING: complex (coulomb matrix) engenvalues for ' + fname + ' employing np.linalg.eigvals function.\n') 
-        eigValues = -np.sort(-np.linalg.eigvalsh(sCoulomb))
-        if np.any(np.iscomplex(eigValues)):
-            # print('\nWARNING: complex (coulomb matrix) engenvalues for ' + fname + ' employing np.linalg.eigvalsh function.\n WARNING: only the real part will be returned.\n')
-            return eigValues.real#[0:natoms]
-        else :
-            return eigValues#[0:atoms]
+    charge = elements.NUMBERS[elements.encode(atomtypes)]
+    return eigenCoulombBatch(coords[np.newaxis], charge[np.newaxis])[0]
         
-def generateXYZ(list_atoms, list_coords, energy, pfile, outfolder):
+def formatXYZ(list_atoms, list_coords, energy) -> str:
+    lines = [f'{len(list_atoms)}\n', f"Energy = {energy}\n"]
+    for idx in range(len(list_atoms)):
+        lines.append(f" {list_atoms[idx]} "+" ".join(map(str, list_coords[idx])) + '\n')
+    return "".join(lines)
+
+def generateXYZ(list_atoms, list_coords, energy, pfile, outfolder, **provenance):
+    """
+    Write a structure to outfolder/pfile.xyz, or append it when outfolder
+    is an archive or a structure store (see core/storage.py); provenance
+    (source, permutation, sample) is only kept by structure stores
+    """
+    if not isinstance(outfolder, str):
+        outfolder.write(list_atoms, list_coords, energy, pfile, **provenance)
+        return
     fname = outfolder+pfile+'.xyz'
     with open(fname, 'w') as file:
-        file.write(f'{len(list_atoms)}\n')
-        file.write(f"Energy = {energy}\n")
-        for idx in range(len(list_atoms)):
-            file.write(f" {list_atoms[idx]} "+" ".join(map(str, list_coords[idx])) + '\n')
-
-def getCoulombEig(files):
-    X = []
-    list_atoms = []
+        file.write(formatXYZ(list_atoms, list_coords, energy))
+
+def readFilesFrames(files, rows: list = None):
+    """
+    Stream the frames of a list of XYZ files, as readFrames; when given,
+    `rows` receives the (file, frame index, name) of every frame yielded
+    """
+    for file in files:
+        for index, frame in enumerate(readFrames(file)):
+            if rows is not None:
+                rows.append((file, index, frame[0]))
+            yield frame
+
+def getCoulombEig(files, rows: list = None):
+    return getCoulombEigFrames(readFilesFrames(files, rows))
+
+def getCoulombEigFrames(frames):
+    """
+    Scaled Coulomb eigenvalues and energies of a stream of (name, codes, coords, energy)
+    """
+    coulomb, energies = eigenCoulombFrames(frames)
+    return scaleDescriptors(coulomb), energies
+
+def scaleDescriptors(coulomb):
+    return StandardScaler().fit_transform(coulomb)
+
+def eigenCoulombFrames(frames):
     list_coords = []
-    coulomb = []
+    list_charges = []
     energies = []
-    for file in files:
-        natoms, atomtypes, coords, energy = xyzRead(file)
-        coulomb.append(eigenCoulomb(natoms, atomtypes, coords))
-        energies.append(energy)            
-    coulomb = np.array(coulomb)
-    coulomb = StandardScaler().fit_transform(coulomb)
+    for name, codes, coords, energy in frames:
+        list_coords.append(coords)
+        list_charges.append(elements.NUMBERS[codes])
+        energies.append(energy)
+    coulomb = eigenCoulombBatch(np.array(list_coords), np.array(list_charges))
     return coulomb, energies
+
+def writeEigenCoulomb(frames, fname: str, chunk: int = 1024):
+    """
+    Stream the Coulomb eigenvalues of a stream of (name, codes, coords, energy)
+    to a raw float64 file and return it memory-mapped, (n_frames, natoms)
+    The file grows chunk by chunk, so the number of frames need not be known
+    Only `chunk` structures are held in memory at a time
+    """
+    n_frames = 0
+    natoms = 0
+    batch_coords = []
+    batch_charges = []
+    with open(fname, "wb") as out:
+        for name, codes, coords, energy in frames:
+            natoms = len(codes)
+            batch_coords.append(coords)
+            batch_charges.append(elements.NUMBERS[codes])
+            if len(batch_coords) == chunk:
+                eigenCoulombBatch(np.array(batch_coords), np.array(batch_charges)).astype("float64").tofile(out)
+                n_frames += chunk
+                batch_coords, batch_charges = [], []
+        if batch_coords:
+            eigenCoulombBatch(np.array(batch_coords), np.array(batch_charges)).astype("float64").tofile(out)
+            n_frames += len(batch_coords)
+    if n_frames == 0:
+        return np.zeros((0, 0))
+    return np.memmap(fname, dtype="float64", mode="r", shape=(n_frames, natoms))
@@ -21,6 +21,7 @@ import sys
 import random
 import json
 import glob
+import tempfile
 import numpy as np
 import tqdm
 
@@ -31,6 +32,8 @@ import core.permute as perm
 import core.tools as tools
 import core.frames as gen
 import core.complexes as complexes
+import core.elements as elements
+import core.storage as storage
 
 
 
@@ -101,22 +104,30 @@ def M0_Selection(params: dict, adhoc: bool) -> None:
 
 	print(f"\n\t\t\tLoading files from: {inputfolder}")
 
+	source = storage.open_source(inputfolder)
+	if source is not None:
+		M0_Selection_stage(params, source, outfolder, adhoc)
+		print("\n\t\tEnd of module 0 - Representative Selection")
+		return
+
 	files=sorted(glob.glob(f"{inputfolder}/*.xyz"))
 	if not files:
 		print(f"\n\t\t\tFail - Folder {inputfolder} is empty\n\n")
 		exit()
 
 	print(f"\n\t\t\tSample Selection - Files Loaded {len(files)}")
-	if len(files) > 1:
-		coulomb, energies = tools.getCoulombEig(files)
-		sel_samples = rep.get_representatives(params, coulomb, energies, files)
+	rows = [] # (file, frame index, name) of every structure, multi-frame files give several
+	if params.get("SELECTION", "KMEANS") == "MINIBATCH":
+		sel_samples = streamed_representatives(params, tools.readFilesFrames(files, rows))
 	else:
-		sel_samples = [0]
-
-	for id in sel_samples:
-		infile = files[id]
-		outfile = f"{outfolder}/{os.path.basename(infile)}"
-		os.system(f"cp {infile} {outfile}")
+		coulomb, energies = tools.getCoulombEig(files, rows)
+		if len(rows) > 1:
+			sel_samples = rep.get_unique_representatives(params, coulomb, energies, [name for _, _, name in rows],
+			                                             f"{outfolder}/duplicates.csv")
+		else:
+			sel_samples = list(range(len(rows)))
+
+	copy_selection(rows, sel_samples, outfolder)
 	inFiles = len(glob.glob(f"{outfolder}/*.xyz"))
 	print(f"\n\t\t\tTotal of Selected Samples: {inFiles}")
 
@@ -124,12 +135,88 @@ def M0_Selection(params: dict, adhoc: bool) -> None:
 
 	print("\n\t\tEnd of module 0 - Representative Selection")
 
+def copy_selection(rows: list, sel_samples: list, outfolder: str) -> None:
+	"""
+	Copy the selected structures to outfolder: the whole file when it holds a single frame,
+	otherwise only the selected frames, one XYZ file each
+	"""
+	frames_per_file = {}
+	for file, _, _ in rows:
+		frames_per_file[file] = frames_per_file.get(file, 0) + 1
+	wanted = {}
+	for id in sel_samples:
+		file, index, _ = rows[id]
+		if frames_per_file[file] == 1:
+			os.system(f"cp {file} {outfolder}/{os.path.basename(file)}")
+		else:
+			wanted.setdefault(file, set()).add(index)
+	for file, indices in wanted.items():
+		for index, (name, codes, coords, energy) in enumerate(tools.readFrames(file)):
+			if index in indices:
+				tools.generateXYZ(elements.decode(codes), coords, energy, name, f"{outfolder}/")
+
+def M0_Selection_stage(params: dict, source, outfolder: str, final: bool = False) -> None:
+	"""
+	Module 0 over an archive or a structure store: the selection is written in the same layout
+	final - outfolder is an output folder: a selected store is also exported as XYZ files, as
+	        StructureStore.copy_to does for the outputs of modules 1 to 3
+	"""
+	names = source.names()
+	print(f"\n\t\t\tSample Selection - Structures Loaded {len(names)}")
+	if len(names) > 1 and params.get("SELECTION", "KMEANS") == "MINIBATCH":
+		if isinstance(source, storage.StructureStore): # descriptors are kept in the store
+			sel_samples = rep.get_representatives_stream(params, source.descriptors())
+		else:
+			sel_samples = streamed_representatives(params, source.frames())
+	elif len(names) > 1:
+		coulomb = tools.scaleDescriptors(source.descriptors())
+		sel_samples = rep.get_unique_representatives(params, coulomb, source.energies(), names,
+		                                             f"{outfolder}/duplicates.csv")
+	else:
+		sel_samples = [0]
+
+	target = source.subset(sel_samples, outfolder)
+	if final and isinstance(target, storage.StructureStore):
+		target.export(outfolder)
+	print(f"\n\t\t\tTotal of Selected Samples: {len(target)}")
+
+	print(f"\n\t\t\tSelectec Structures are available at {outfolder}")
+
+def streamed_representatives(params: dict, frames) -> list:
+	"""
+	MINIBATCH selection: the descriptors are streamed to a memory-mapped
+	file in the system temporary folder and clustered from there
+	"""
+	with tempfile.TemporaryDirectory() as tmpdir:
+		descriptors = tools.writeEigenCoulomb(frames, f"{tmpdir}/descriptors.bin")
+		if len(descriptors) > 1:
+			sel_samples = rep.get_representatives_stream(params, descriptors)
+		else:
+			sel_samples = list(range(len(descriptors)))
+		del descriptors
+	return sel_samples
+
+def copy_outputs(filfold: str, outfolder: str) -> None:
+	"""
+	Copy the final structures of a module to its output folder
+	"""
+	print(f"\n\t\tCopying final files to the output folder")
+	source = storage.open_source(filfold)
+	if source is not None:
+		source.copy_to(outfolder)
+		return
+	files=glob.glob(f"{filfold}/*.xyz")
+	for file in tqdm.tqdm(files):
+		os.system(f"cp {file} {outfolder}/")
+
 def M1_frame_family(params: dict) -> None:
 	print("\n\nModule 1: Frame Family:")
 
 	tmpfolder = params["MOD1"]["TMP_FOLDER"]
 	outfolder = params["MOD1"]["OUTPUT_FOLDER"]
 	threshold = params["MOD1"]["INTEGRITY"]
+	integrity_jobs = params["MOD1"].get("INTEGRITY_JOBS", 1)
+	fmt = params["MOD1"].get("OUTPUT_FORMAT", "XYZ")
 	os.system("rm -rf log.txt")
 	os.system(f"rm -rf {tmpfolder}")
 	os.system(f"rm -rf {outfolder}")
@@ -139,8 +226,26 @@ def M1_frame_family(params: dict) -> None:
 	os.system(f"mkdir {tmpfolder}/selected")
 	os.system(f"mkdir {outfolder}")
 
+	streaming = params["MOD1"].get("STREAMING", False)
+	if streaming:
+		unfiltered = net.StreamFilter(storage.open_stage(f"{tmpfolder}/filtered/", fmt), threshold,
+			net.is_connected, params["MOD1"].get("TARGET"))
+	else:
+		unfiltered = storage.open_stage(f"{tmpfolder}/unfiltered/", fmt)
+
 	inFiles = 0
-	if params["MOD1"]["INPUT_FOLDER"]:
+	if params["MOD1"]["INPUT_FOLDER"] and not isinstance(unfiltered, str):
+		inputfolder = params["MOD1"]["INPUT_FOLDER"]
+		print(f"\t\tLoading Unary geometries from: {inputfolder}")
+		files = sorted(glob.glob(f"{inputfolder}/*.xyz")) + sorted(glob.glob(f"{inputfolder}/*/*.xyz"))
+		for file in files:
+			subf = os.path.basename(file)
+			if os.path.dirname(file) != os.path.normpath(inputfolder):
+				subf = f"{os.path.basename(os.path.dirname(file))}_{subf}"
+			unfiltered.import_file(file, os.path.splitext(subf)[0])
+		inFiles = len(unfiltered)
+		print(f"\t\t\tTotal of Unary geometries from: {inputfolder}: {inFiles}")
+	elif params["MOD1"]["INPUT_FOLDER"]:
 		inputfolder = params["MOD1"]["INPUT_FOLDER"]
 		files=sorted(glob.glob(f"{inputfolder}/*.xyz"))
 		if files:
@@ -165,31 +270,48 @@ def M1_frame_family(params: dict) -> None:
 	numsamples = params["MOD1"]["NUMGEN"]
 	factor = params["MOD1"]["RADIUS_FACTOR"]
 	gamma = params["MOD1"]["GAMMA"]
+	sampler = params["MOD1"].get("SAMPLER", "SERIAL")
+	n_jobs = params["MOD1"].get("N_JOBS", 1)
+	seed = params["MOD1"].get("SEED")
+	spatial_index = params["MOD1"].get("SPATIAL_INDEX", False)
+	budget = {}
+	if sampler=="ADAPTIVE":
+		budget = {"max_attempts": params["MOD1"].get("MAX_ATTEMPTS", 100000),
+			"max_restarts": params["MOD1"].get("MAX_RESTARTS", 100)}
 
 	natoms = 0
-	elements = []
+	species = []
 	for key, value in params.items():
 		if key.startswith("NUMELEM"):
 			natoms += value
 		if key.startswith("ELEM"):
-			elements.append(value)
+			species.append(value)
 
-	for atom in elements:
+	for atom in species:
+		if getattr(unfiltered, "done", False): # streaming filter reached its target
+			break
 		print(f"\t\tGenerating new structures of {atom}{natoms}...")
-		gen.genSamples(numsamples, "CUBE", atom, natoms, factor, gamma, f"{tmpfolder}/unfiltered/")
-		gen.genSamples(numsamples, "SPHERE", atom, natoms, factor, gamma, f"{tmpfolder}/unfiltered/")
+		for shape in ("CUBE", "SPHERE"):
+			if getattr(unfiltered, "done", False):
+				break
+			gen.genSamples(numsamples, shape, atom, natoms, factor, gamma, unfiltered, sampler, n_jobs, seed, spatial_index, **budget)
+	if streaming:
+		inFiles = len(unfiltered) - inFiles
+		print(f"\t\t\tTotal of Generated Frames: {inFiles}")
+		unfiltered.close() # survivors are already in /filtered
+	else:
+		storage.close_stage(unfiltered)
 
-	inFiles = len(glob.glob(f"{tmpfolder}/unfiltered/*.xyz")) - inFiles
-	print(f"\t\t\tTotal of Generated Frames: {inFiles}")
+		inFiles = storage.stage_count(f"{tmpfolder}/unfiltered") - inFiles
+		print(f"\t\t\tTotal of Generated Frames: {inFiles}")
 
-	print("\n\t\tTesting the integrity of the nanoclusters")
-	net.integrity_test(tmpfolder, threshold) # /unfiltered to /filtered
+		print("\n\t\tTesting the integrity of the nanoclusters")
+		net.integrity_test(tmpfolder, threshold, integrity_jobs) # /unfiltered to /filtered
 
-	inFiles = len(glob.glob(f"{tmpfolder}/filtered/*.xyz"))
+	inFiles = storage.stage_count(f"{tmpfolder}/filtered")
 	print(f"\t\t\tTotal of Frames After the Integrity Test: {inFiles}")
 
-	files=glob.glob(f"{tmpfolder}/filtered/*.xyz")
-	if not files:
+	if not inFiles:
 		print("\n\nERROR: Frames did not pass the integrity test\n\n")
 		exit()
 
@@ -205,10 +327,7 @@ def M1_frame_family(params: dict) -> None:
 
 	# os.system(f"cp {filfold}/*.xyz {outfolder}/")
 
-	print(f"\n\t\tCopying final files to the output folder")
-	files=glob.glob(f"{filfold}/*.xyz")
-	for file in tqdm.tqdm(files):
-		os.system(f"cp {file} {outfolder}/")
+	copy_outputs(filfold, outfolder)
 
 	print(f"\n\t\tFrames are available at {outfolder}")
 
@@ -221,7 +340,11 @@ def M2_core_family(params: dict) -> None:
 	tmpfolder = params["MOD2"]["TMP_FOLDER"]
 	outfolder = params["MOD2"]["OUTPUT_FOLDER"]
 	threshold = params["MOD2"]["INTEGRITY"]
+	integrity_jobs = params["MOD2"].get("INTEGRITY_JOBS", 1)
 	maxgen_frame = params["MOD2"]["MAX_GEN_PER_FRAME"]
+	n_jobs = params["MOD2"].get("N_JOBS", 1)
+	seed = params["MOD2"].get("SEED")
+	fmt = params["MOD2"].get("OUTPUT_FORMAT", "XYZ")
 
 	os.system(f"rm -rf {tmpfolder}")
 	os.system(f"rm -rf {outfolder}")
@@ -233,35 +356,43 @@ def M2_core_family(params: dict) -> None:
 
 	print(f"\n\t\tLoading frames from: {inputfolder}")
 
-	files=sorted(glob.glob(f"{inputfolder}/*.xyz"))
-	if not files:
+	frames = list(storage.stage_frames(inputfolder))
+	if not frames:
 		print(f"\n\t\tFail - Folder {inputfolder} is empty\n\n")
 		exit()
 
-	combinations = perm.get_templates(params)
-	print(f"\t\t\tTotal of files: {len(files)}")
-	print(f"\t\t\tMax Permutations per file: {len(combinations)}")
+	n_templates = perm.count_templates(params)
+	print(f"\t\t\tTotal of files: {len(frames)}")
+	print(f"\t\t\tMax Permutations per file: {n_templates}")
 
 	print(f"\n\t\tGenerating Cores:")
-	if len(combinations) < maxgen_frame:
+	if n_templates < maxgen_frame:
 		print(f"\t\t\tWARNING: Generations ({maxgen_frame}) exceed the maximum permutations")
-		print(f"\t\t\t         A total of {len(combinations)} cores will be generated per frame")
+		print(f"\t\t\t         A total of {n_templates} cores will be generated per frame")
 	else:
 		print(f"\t\t\tA total of {maxgen_frame} cores will be generated per frame")
 
-	perm.gen_permutations(params, files)
+	if params["MOD2"].get("STREAMING", False):
+		unfiltered = net.StreamFilter(storage.open_stage(f"{tmpfolder}/filtered/", fmt), threshold,
+			net.is_connected, params["MOD2"].get("TARGET"))
+		perm.gen_permutations(params, frames, unfiltered, n_jobs, seed)
+		print(f"\t\t\tTotal of Cores: {len(unfiltered)}")
+		unfiltered.close() # survivors are already in /filtered
+	else:
+		unfiltered = storage.open_stage(f"{tmpfolder}/unfiltered/", fmt)
+		perm.gen_permutations(params, frames, unfiltered, n_jobs, seed)
+		storage.close_stage(unfiltered)
 
-	inFiles = len(glob.glob(f"{tmpfolder}/unfiltered/*.xyz"))
-	print(f"\t\t\tTotal of Cores: {inFiles}")
+		inFiles = storage.stage_count(f"{tmpfolder}/unfiltered")
+		print(f"\t\t\tTotal of Cores: {inFiles}")
 
-	print("\n\t\tTesting the integrity of the nanoclusters:")
-	net.integrity_test(tmpfolder, threshold) # /unfiltered to /filtered
+		print("\n\t\tTesting the integrity of the nanoclusters:")
+		net.integrity_test(tmpfolder, threshold, integrity_jobs) # /unfiltered to /filtered
 
-	inFiles = len(glob.glob(f"{tmpfolder}/filtered/*.xyz"))
+	inFiles = storage.stage_count(f"{tmpfolder}/filtered")
 	print(f"\t\t\tTotal of Cores After the Integrity Test: {inFiles}")
 
-	files=glob.glob(f"{tmpfolder}/filtered/*.xyz")
-	if not files:
+	if not inFiles:
 		print("\n\nERROR: Cores did not pass the integrity test\n\n")
 		exit()
 
@@ -276,10 +407,7 @@ def M2_core_family(params: dict) -> None:
 		filfold = tmpfolder+"/filtered"
 
 	# os.system(f"cp {filfold}/*.xyz {outfolder}/")
-	print(f"\n\t\tCopying final files to the output folder")
-	files=glob.glob(f"{filfold}/*.xyz")
-	for file in tqdm.tqdm(files):
-		os.system(f"cp {file} {outfolder}/")
+	copy_outputs(filfold, outfolder)
 
 
 	print(f"\n\t\tCores are available at {outfolder}")
@@ -294,6 +422,8 @@ def M3_add_ligants(params: dict) -> None:
 	tmpfolder = params["MOD3"]["TMP_FOLDER"]
 	outfolder = params["MOD3"]["OUTPUT_FOLDER"]
 	threshold = params["MOD3"]["INTEGRITY"]
+	integrity_jobs = params["MOD3"].get("INTEGRITY_JOBS", -1)
+	fmt = params["MOD3"].get("OUTPUT_FORMAT", "XYZ")
 	os.system(f"rm -rf {tmpfolder}")
 	os.system(f"rm -rf {outfolder}")
 	os.system(f"mkdir {tmpfolder}")
@@ -310,6 +440,7 @@ def M3_add_ligants(params: dict) -> None:
 	ligdist = params["MOD3"]["LIGANDS_DISTANCE"]
 	sites_ids = list(range(nsites))
 	deformation = params["MOD3"]["DEFORMATION"]
+	ligand_retries = params["MOD3"].get("LIGANDS_RETRIES")
 
 	natoms = 0
 	for key, value in params.items():
@@ -317,7 +448,7 @@ def M3_add_ligants(params: dict) -> None:
 			natoms += value
 
 	print(f"\n\t\tLoading Cores from: {coresfolder}")
-	cores=sorted(glob.glob(f"{coresfolder}/*.xyz"))
+	cores = list(storage.stage_frames(coresfolder))
 	if len(cores) < ncores:
 		ncores = len(cores)
 	print(f"\t\t\tTotal of Cores in the Folder: {len(cores)} - Up to {ncores} cores will be loaded")
@@ -346,15 +477,29 @@ def M3_add_ligants(params: dict) -> None:
 		print(f"\n\t\t\tFail - Number of ligands [{np.sum(lig_distribution)}] is superior to the number of atoms in the core [{natoms}]\n\n")
 		exit()
 
-	for core in tqdm.tqdm(cores):
-		base_name = os.path.basename(core)
-		base_name = os.path.splitext(base_name)[0]
-		core_natoms, core_atomtypes, core_coords, _ = tools.xyzRead(core)
+	streaming = params["MOD3"].get("STREAMING", False)
+	if streaming:
+		unfiltered = net.StreamFilter(storage.open_stage(f"{tmpfolder}/filtered/", fmt), threshold,
+			net.has_no_clash, params["MOD3"].get("TARGET"), batch_check=net.clash_free_chunk)
+	else:
+		unfiltered = storage.open_stage(f"{tmpfolder}/unfiltered/", fmt)
+	lig_codes = [elements.encode(tools.xyzRead(ligand)[1]) for ligand in ligands[:len(lig_distribution)]]
+	abandoned = 0
+	for base_name, core_codes, core_coords, _ in tqdm.tqdm(cores):
+		if getattr(unfiltered, "done", False): # streaming filter reached its target
+			break
+		if ligand_retries is not None and not net.has_no_clash(core_codes, core_coords, threshold):
+			abandoned += numsim # every complex of this core would fail the integrity test
+			continue
+		reach = 2.0*np.max(elements.RADII[np.concatenate([core_codes, *lig_codes])])
+		core_atomtypes = elements.decode(core_codes)
 		core_coords = complexes.center_mol(core_coords)
 		sites = complexes.fibonacci_sphere(nsites)
 		sites = complexes.optimize_sites(sites) # Force-field approach to optimize the sites
 
 		for sim in range(numsim):
+			if getattr(unfiltered, "done", False):
+				break
 			sites = complexes.rotate_atoms(sites) #random rotation of the sites
 			decision = random.random()
 			if decision < 0.5:
@@ -366,6 +511,8 @@ def M3_add_ligants(params: dict) -> None:
 			random.shuffle(sites_ids)
 			complex_atoms = core_atomtypes[:]
 			complex_coords = core_coords[:]
+			complex_codes = core_codes
+			placed = True
 			for idx, numlig in enumerate(lig_distribution):
 				lig_natoms, lig_atomtypes, lig_coords, _ = tools.xyzRead(ligands[idx])
 				lig_coords = complexes.rotate_atoms(lig_coords) #random rotation of the ligands
@@ -373,23 +520,44 @@ def M3_add_ligants(params: dict) -> None:
 				for lig in range(numlig):
 					dist = np.linalg.norm(core_sites[sites_ids[idx_site]])
 					direction = np.array(core_sites[sites_ids[idx_site]])/dist
-					to_append = complexes.positining_ligand(lig_coords, direction, dist, core_coords, lig_orientation[idx])
+					if ligand_retries is None:
+						to_append = complexes.positining_ligand(lig_coords, direction, dist, core_coords, lig_orientation[idx])
+					else:
+						to_append = complexes.place_ligand(lig_coords, direction, dist, core_coords, lig_orientation[idx],
+							complex_codes, complex_coords, lig_codes[idx], threshold, reach, ligand_retries)
+						if to_append is None: # no clash-free orientation within the budget
+							placed = False
+							break
+						complex_codes = np.concatenate((complex_codes, lig_codes[idx]))
 					complex_atoms.extend(lig_atomtypes)
 					complex_coords = np.concatenate((complex_coords, to_append), axis=0)
 					idx_site += 1
+				if not placed:
+					break
+
+			if not placed:
+				abandoned += 1
+				continue
+
+			pfile = base_name+"_C"+str(sim)
+			tools.generateXYZ(complex_atoms, complex_coords, 0.0, pfile, unfiltered,
+							  source=base_name, sample=sim)
+	if ligand_retries is not None:
+		print(f"\t\t\tComplexes abandoned during ligand placement: {abandoned}")
+	if streaming:
+		print(f"\t\t\tTotal of Generated Complexes: {len(unfiltered)}")
+		unfiltered.close() # survivors are already in /filtered
+	else:
+		storage.close_stage(unfiltered)
 
-			pfile = "/"+base_name+"_C"+str(sim)
-			tools.generateXYZ(complex_atoms, complex_coords, 0.0, pfile, tmpfolder+"/unfiltered")
-
-	inFiles = len(glob.glob(f"{tmpfolder}/unfiltered/*.xyz"))
-	print(f"\t\t\tTotal of Generated Complexes: {inFiles}")
-	print("\n\t\tTesting the integrity of the complexes")
-	net.integrity_test_complexes_hpc(tmpfolder, threshold)
-	inFiles = len(glob.glob(f"{tmpfolder}/filtered/*.xyz"))
+		inFiles = storage.stage_count(f"{tmpfolder}/unfiltered")
+		print(f"\t\t\tTotal of Generated Complexes: {inFiles}")
+		print("\n\t\tTesting the integrity of the complexes")
+		net.integrity_test_complexes_hpc(tmpfolder, threshold, integrity_jobs)
+	inFiles = storage.stage_count(f"{tmpfolder}/filtered")
 	print(f"\t\t\tTotal of Complexes After The Integrity Test:: {inFiles}")
 
-	files=glob.glob(f"{tmpfolder}/filtered/*.xyz")
-	if not files:
+	if not inFiles:
 		print("\n\nERROR: Complexes did not pass the integrity test\n\n")
 		exit()
 
@@ -401,10 +569,7 @@ def M3_add_ligants(params: dict) -> None:
 	else:
 		filfold = tmpfolder+"/filtered"
 
-	print(f"\n\t\tCopying final files to the output folder")
-	files=glob.glob(f"{filfold}/*.xyz")
-	for file in tqdm.tqdm(files):
-		os.system(f"cp {file} {outfolder}/")
+	copy_outputs(filfold, outfolder)
 	# os.system(f"cp {filfold}/*.xyz {outfolder}/")	
 
 	print(f"\n\t\tComplexes are available at {outfolder}")